@@ -0,0 +1,212 @@
+"""Локальная замена Telegram Bot API для нагрузочных тестов бота.
+
+Поддерживает getUpdates и webhook, sendMessage, editMessageText,
+editMessageReplyMarkup и answerCallbackQuery. Умеет добавлять задержку
+ответа, отвечать 429 при превышении лимита и 403 для заблокированных чатов.
+Также отдаёт подставной worldstate в формате AllOrigins (/worldstate).
+"""
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+# Методы, на которые распространяется лимит отправки
+SEND_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup'}
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+
+class FakeTelegramServer:
+    """Bot API в памяти процесса: внедряет обновления и записывает ответы бота"""
+
+    def __init__(self, host='127.0.0.1', port=8081, latency=0.0, rate_limit=None,
+                 retry_after=1, blocked_chats=(), worldstate=None):
+        self.host = host
+        self.port = port
+        self.latency = latency            # секунды на каждый вызов метода
+        self.rate_limit = rate_limit      # отправок в секунду на всех (None — без лимита)
+        self.retry_after = retry_after
+        self.blocked_chats = set(blocked_chats)
+        self.worldstate = worldstate or {}
+
+        self.updates = deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.updates_cond = threading.Condition()
+        self.webhook_url = None
+        self.webhook_secret = None
+
+        self.lock = threading.Lock()
+        self.send_times = deque()         # окно последней секунды для лимита
+        self.callback_chats = {}          # callback_query_id -> chat_id
+        self.calls = []                   # (время, метод, chat_id, текст)
+        self.errors = {429: 0, 403: 0}
+        self.listeners = []               # вызываются на каждый ответ бота: (метод, chat_id, время)
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule('/bot<token>/<method>', 'method', self.handle, methods=['GET', 'POST'])
+        self.app.add_url_rule('/worldstate', 'worldstate', self.get_worldstate)
+        self.server = None
+
+    @property
+    def api_url(self):
+        """Шаблон для telebot.apihelper.API_URL"""
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    @property
+    def worldstate_url(self):
+        return f"http://{self.host}:{self.port}/worldstate"
+
+    def start(self):
+        self.server = make_server(self.host, self.port, self.app, threaded=True)
+        self.port = self.server.server_port  # при port=0 выбирается свободный порт
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    # --- Внедрение обновлений ---
+
+    def inject_message(self, chat_id, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f"user{chat_id}"},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"},
+            'text': text
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self.push_update({'message': message})
+
+    def inject_callback(self, chat_id, data, message_id=1):
+        query_id = str(next(self.update_ids))
+        with self.lock:
+            self.callback_chats[query_id] = chat_id
+        return self.push_update({'callback_query': {
+            'id': query_id,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"},
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': '...'
+            }
+        }})
+
+    def push_update(self, update):
+        update['update_id'] = next(self.update_ids)
+        if self.webhook_url:
+            headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+            threading.Thread(target=requests.post, args=(self.webhook_url,),
+                             kwargs={'json': update, 'headers': headers, 'timeout': 30}).start()
+        else:
+            with self.updates_cond:
+                self.updates.append(update)
+                self.updates_cond.notify_all()
+        return update
+
+    # --- Обработка вызовов Bot API ---
+
+    def get_worldstate(self):
+        return jsonify({'contents': json.dumps(self.worldstate)})
+
+    def handle(self, token, method):
+        params = request.values.to_dict()
+        if request.is_json:
+            params.update(request.get_json(silent=True) or {})
+
+        if method == 'getUpdates':
+            return self.get_updates(params)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id not in (None, '') else None
+        if method == 'answerCallbackQuery':
+            with self.lock:
+                chat_id = self.callback_chats.pop(params.get('callback_query_id'), None)
+
+        if method in SEND_METHODS:
+            if chat_id in self.blocked_chats:
+                return self.error(403, "Forbidden: bot was blocked by the user")
+            if not self.take_send_slot():
+                return self.error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                  {'retry_after': self.retry_after})
+
+        now = time.time()
+        with self.lock:
+            self.calls.append((now, method, chat_id, params.get('text')))
+        for listener in self.listeners:
+            listener(method, chat_id, now)
+
+        if method == 'getMe':
+            return self.ok(BOT_USER)
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url') or None
+            self.webhook_secret = params.get('secret_token')
+            return self.ok(True)
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return self.ok(True)
+        if method in SEND_METHODS:
+            return self.ok({
+                'message_id': int(params.get('message_id') or next(self.message_ids)),
+                'date': int(now),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', '')
+            })
+        return self.ok(True)
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.time() + float(params.get('timeout') or 0)
+        with self.updates_cond:
+            # Подтверждённые обновления удаляются, как в настоящем API
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates and time.time() < deadline:
+                self.updates_cond.wait(deadline - time.time())
+            batch = list(itertools.islice(self.updates, limit))
+        return self.ok(batch)
+
+    def take_send_slot(self):
+        if not self.rate_limit:
+            return True
+        now = time.time()
+        with self.lock:
+            while self.send_times and now - self.send_times[0] >= 1:
+                self.send_times.popleft()
+            if len(self.send_times) >= self.rate_limit:
+                self.errors[429] += 1
+                return False
+            self.send_times.append(now)
+            return True
+
+    def ok(self, result):
+        return jsonify({'ok': True, 'result': result})
+
+    def error(self, code, description, parameters=None):
+        if code == 403:
+            with self.lock:
+                self.errors[403] += 1
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return jsonify(body), code
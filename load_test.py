@@ -0,0 +1,201 @@
+"""Нагрузочный тест бота целиком в одном процессе.
+
+Поднимает FakeTelegramServer, запускает бота поверх него и моделирует
+пользователей, которые нажимают кнопки меню и настраивают фильтры разрывов.
+В конце рассылает уведомления о разрывах и измеряет пропускную способность.
+
+    python load_test.py --users 2000 --concurrency 100 --latency 0.02 --rate-limit 30
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from fake_telegram import FakeTelegramServer
+
+TIERS = ['Lith', 'Meso', 'Neo', 'Axi', 'Requiem', 'Omnia']
+MISSIONS = ['Survival', 'Defense', 'Capture', 'Exterminate', 'Rescue', 'Spy', 'Interception', 'Sabotage']
+
+
+def make_worldstate(fissure_count):
+    """Подставной worldstate с заданным числом свежих разрывов"""
+    now = datetime.now(timezone.utc)
+    iso = lambda dt: dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    fissures = []
+    for i in range(fissure_count):
+        fissures.append({
+            'id': f"load{i}",
+            'activation': iso(now - timedelta(minutes=1)),
+            'expiry': iso(now + timedelta(minutes=50)),
+            'node': f"Node {i} (Void)",
+            'missionType': MISSIONS[i % len(MISSIONS)],
+            'tier': TIERS[i % len(TIERS)],
+            'isHard': i % 5 == 0,
+            'isStorm': False,
+            'eta': '50m'
+        })
+    return {
+        # is_data_valid требует непустые события и вторжения
+        'events': [{'id': 'load_event', 'description': 'Load test', 'node': 'Earth',
+                    'expiry': iso(now + timedelta(days=2)), 'active': True, 'rewards': []}],
+        'invasions': [{'id': 'load_invasion', 'activation': iso(now - timedelta(hours=1)), 'node': 'Mars',
+                       'completed': False, 'eta': '5h',
+                       'attacker': {'faction': 'Grineer', 'reward': {'countedItems': []}},
+                       'defender': {'faction': 'Corpus', 'reward': {'countedItems': []}}}],
+        'fissures': fissures,
+        'voidTraders': [{'location': 'Strata Relay (Earth)', 'activation': iso(now + timedelta(days=3)),
+                         'expiry': iso(now + timedelta(days=5)), 'active': False, 'inventory': []}],
+    }
+
+
+class ReplyTracker:
+    """Ждёт первого ответа бота в чат после внедрённого обновления"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = {}  # chat_id -> Event
+
+    def expect(self, chat_id):
+        event = threading.Event()
+        with self.lock:
+            self.waiting[chat_id] = event
+        return event
+
+    def __call__(self, method, chat_id, moment):
+        with self.lock:
+            event = self.waiting.pop(chat_id, None)
+        if event:
+            event.moment = moment
+            event.set()
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def simulate_user(fake, tracker, wb, chat_id, actions, reply_timeout, latencies, timeouts):
+    """Один пользователь: /start, подписка на разрывы, случайные действия"""
+    filter_callbacks = [f"fissure_type_{m}" for m in MISSIONS] + [f"fissure_tier_{t}" for t in TIERS]
+    script = [('text', '/start'), ('callback', 'toggle_fissures'), ('text', wb.LOCALE['FISSURE_FILTERS'])]
+    for _ in range(actions):
+        if random.random() < 0.5:
+            script.append(('text', random.choice(wb.LOCALE['MENU'])))
+        else:
+            script.append(('callback', random.choice(filter_callbacks)))
+    script.append(('callback', 'fissure_filter_save'))
+
+    for kind, payload in script:
+        event = tracker.expect(chat_id)
+        started = time.time()
+        if kind == 'text':
+            fake.inject_message(chat_id, payload)
+        else:
+            fake.inject_callback(chat_id, payload)
+        if event.wait(reply_timeout):
+            latencies.append(event.moment - started)
+        else:
+            timeouts.append(payload)
+
+
+def pending_outbox(wb):
+    """Сообщения в очереди плюс незавершённые проходы рассылки, которые ещё добавят сообщения"""
+    with sqlite3.connect(wb.DATABASE) as conn:
+        return (
+            conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            + conn.execute("SELECT COUNT(*) FROM notify_passes").fetchone()[0]
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременно активных пользователей")
+    parser.add_argument('--actions', type=int, default=5, help="действий на пользователя после настройки")
+    parser.add_argument('--fissures', type=int, default=12)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument('--rate-limit', type=int, default=None, help="отправок в секунду до ответа 429")
+    parser.add_argument('--blocked', type=float, default=0.0, help="доля чатов, заблокировавших бота")
+    parser.add_argument('--send-rate', type=int, default=None, help="переопределить OUTBOX_MAX_RATE")
+    parser.add_argument('--reply-timeout', type=float, default=10.0)
+    parser.add_argument('--drain-timeout', type=float, default=600.0)
+    args = parser.parse_args()
+
+    chat_ids = list(range(100000, 100000 + args.users))
+    blocked = set(random.sample(chat_ids, int(len(chat_ids) * args.blocked)))
+    fake = FakeTelegramServer(port=0, latency=args.latency, rate_limit=args.rate_limit,
+                              worldstate=make_worldstate(0)).start()
+
+    # Бот читает настройки при импорте, поэтому окружение задаётся до него
+    workdir = tempfile.mkdtemp(prefix='wf_load_')
+    os.chdir(workdir)
+    os.environ['TELEGRAM_TOKEN'] = '123456:LOADTEST'
+    os.environ['TELEGRAM_API_URL'] = fake.api_url
+    os.environ['API_URL'] = fake.worldstate_url
+    os.environ['DATABASE'] = os.path.join(workdir, 'users.db')
+    import warframe_bot as wb
+
+    wb.DELIVERY_WINDOW = 0  # меряем чистую скорость отправки, без растягивания по окну
+    if args.send_rate:
+        wb.OUTBOX_MAX_RATE = args.send_rate
+    wb.setup_logging()
+    wb.start_services()
+    polling = threading.Thread(target=wb.bot.infinity_polling, kwargs={'timeout': 10, 'long_polling_timeout': 1})
+    polling.daemon = True
+    polling.start()
+
+    tracker = ReplyTracker()
+    fake.listeners.append(tracker)
+    latencies, timeouts = [], []
+
+    print(f"Пользователей: {args.users}, одновременно: {args.concurrency}, рабочая папка: {workdir}")
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for chat_id in chat_ids:
+            pool.submit(simulate_user, fake, tracker, wb, chat_id, args.actions,
+                        args.reply_timeout, latencies, timeouts)
+    elapsed = time.time() - started
+    fake.listeners.remove(tracker)
+
+    print(f"\nИнтерактив: {len(latencies)} ответов за {elapsed:.1f} с ({len(latencies) / elapsed:.1f} в секунду)")
+    if latencies:
+        print(f"  p50 {percentile(latencies, 0.5) * 1000:.0f} мс, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.0f} мс, "
+              f"макс {max(latencies) * 1000:.0f} мс, среднее {statistics.mean(latencies) * 1000:.0f} мс")
+    print(f"  без ответа: {len(timeouts)}")
+
+    # Рассылка: свежие разрывы для всех подписчиков; часть из них уже заблокировала бота
+    fake.blocked_chats = blocked
+    fake.worldstate = make_worldstate(args.fissures)
+    sent_before = sum(1 for call in fake.calls if call[1] == 'sendMessage')
+    started = time.time()
+    wb.check_notifications()
+    queued = pending_outbox(wb)
+    while pending_outbox(wb) and time.time() - started < args.drain_timeout:
+        time.sleep(0.5)
+    elapsed = time.time() - started
+    delivered = sum(1 for call in fake.calls if call[1] == 'sendMessage') - sent_before
+
+    print(f"\nРассылка: в очереди {queued}, доставлено {delivered} за {elapsed:.1f} с "
+          f"({delivered / elapsed:.1f} сообщений в секунду), осталось {pending_outbox(wb)}")
+    print(f"Ответы API: 429 — {fake.errors[429]}, 403 — {fake.errors[403]}")
+    with sqlite3.connect(wb.DATABASE) as conn:
+        inactive = conn.execute("SELECT COUNT(*) FROM users WHERE active=0").fetchone()[0]
+    print(f"Чатов помечено неактивными: {inactive} из {len(blocked)} заблокировавших")
+
+    wb.bot.stop_polling()
+    wb.scheduler.shutdown(wait=False)
+    polling.join(15)
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,25 +6,195 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from dateutil import parser as date_parser
 import sqlite3
 import logging
+import logging.handlers
+import queue
+import atexit
+import signal
+import sys
+from contextlib import contextmanager
 import json
 import os
-from flask import Flask
+from flask import Flask, request, jsonify
 import threading
 import urllib
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    filename='warframe_bot.log',
-    filemode='a'
-)
+import time
+import random
+import hashlib
+import socket
+import re
+import difflib
+from functools import lru_cache
 
 # Конфигурация
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
-API_URL = 'https://api.allorigins.win/get?url=' + urllib.parse.quote('https://api.warframestat.us/pc?language=ru')
-CACHE_TIMEOUT = 120
-DATABASE = 'users.db'
+API_URL = os.getenv("API_URL") or 'https://api.allorigins.win/get?url=' + urllib.parse.quote('https://api.warframestat.us/pc?language=ru')
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # другой сервер Bot API, например "http://127.0.0.1:8081/bot{0}/{1}"
+CACHE_TIMEOUT = 600  # оставшееся время считается при показе, поэтому снимок может жить долго
+DATABASE = os.getenv("DATABASE", 'users.db')
+
+# Предохранитель (circuit breaker) для запросов к API
+UPSTREAM_TIMEOUT = 20           # секунды на один запрос
+BREAKER_FAILURE_THRESHOLD = 3   # подряд идущих сбоев до размыкания
+BREAKER_LATENCY_BUDGET = 8      # секунды: более медленный ответ тоже считается сбоем
+BREAKER_BASE_COOLDOWN = 15      # секунды до первой пробы после размыкания
+BREAKER_MAX_COOLDOWN = 600      # потолок экспоненциальной паузы
+
+# Ограничение команд, которые ходят в API в обход кэша (/refresh, /test_api)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(',') if x.strip()}
+CHAT_BUCKET_CAPACITY = 2        # запросов подряд от одного чата...
+CHAT_BUCKET_REFILL = 60         # ...и секунд на восстановление одного запроса
+GLOBAL_BUCKET_CAPACITY = 10     # то же для всех чатов вместе
+GLOBAL_BUCKET_REFILL = 6
+REFRESH_MIN_AGE = 30            # снимок моложе этого /refresh не перезапрашивает
+
+# Логирование
+LOG_FILE = 'warframe_bot.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024             # ротация по размеру...
+LOG_BACKUP_COUNT = 5
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")  # ...или по времени ('midnight', 'H'), если задано
+LOG_SAMPLE_WINDOW = 60                       # секунды
+LOG_SAMPLE_LIMIT = 5                         # записей с одного места в коде за окно
+SLOW_HANDLER_MS = 1000                       # обработчики дольше этого пишутся как WARNING
+
+# Поиск наград (/find)
+FIND_MAX_RESULTS = 20
+FIND_MIN_PREFIX = 2        # минимальная длина префикса для поиска по началу слова
+FIND_FUZZY_CUTOFF = 0.75   # порог похожести для нечёткого поиска (difflib)
+
+# Inline-режим
+INLINE_MAX_RESULTS = 50             # больше Telegram не принимает
+INLINE_TIMEZONE = 'Europe/Moscow'   # ответ общий для всех, поэтому время в одном поясе
+INLINE_TIMEZONE_LABEL = 'МСК'
+
+WATCHLIST_MAX_TERMS = 50   # предметов в списке наблюдения одного пользователя
+
+# История разрывов/вторжений (/stats)
+STATS_WINDOW_DAYS = 90     # за какой период считать статистику
+
+# Планирование проверок уведомлений (секунды)
+MIN_CHECK_INTERVAL = 30    # не чаще, чем раз в 30 секунд
+MAX_CHECK_INTERVAL = 600   # страховка: не реже, чем раз в 10 минут
+CHECK_DELAY = 15           # запас после ожидаемого изменения, чтобы API успел обновиться
+NOTIFY_JOB_ID = 'check_notifications'
+LEASE_TAKEOVER_JOB_ID = 'lease_takeover'
+
+# Очередь исходящих сообщений
+OUTBOX_POLL_INTERVAL = 5   # секунды между проверками очереди, если она пуста
+OUTBOX_BATCH_SIZE = 20     # сообщений за один проход
+OUTBOX_MAX_ATTEMPTS = 8    # после стольких неудачных попыток сообщение отбрасывается
+OUTBOX_BASE_BACKOFF = 5    # секунды, удваиваются с каждой попыткой
+OUTBOX_MAX_RATE = 25       # сообщений в секунду (лимит Telegram — около 30)
+REMAINING_PLACEHOLDER = '{remaining}'  # заменяется оставшимся временем в момент отправки
+
+# Проходы рассылки по пользователям
+NOTIFY_BATCH_SIZE = 500    # пользователей за один запрос к БД
+NOTIFY_TIME_BUDGET = 20    # секунды на рассылку за запуск; остальное продолжится с сохранённого курсора
+NOTIFY_RESUME_DELAY = 1    # пауза перед продолжением прерванного прохода
+NOTIFY_RESUME_JOB_ID = 'resume_notify_passes'
+NOTIFIED_DEFAULT_TTL = 3600  # срок отметки "уже сообщили" для элементов без собственного expiry
+
+# Планирование доставки уведомлений
+DELIVERY_WINDOW = 120      # секунды: несрочные уведомления равномерно распределяются по этому окну
+
+KEYBOARD_CACHE_SIZE = 256  # число разных состояний фильтров с готовой клавиатурой
+
+FILTER_DRAFT_TTL = 300     # секунды бездействия, после которых черновик фильтров сохраняется сам
+
+INACTIVE_RETENTION_DAYS = 30  # через столько дней недоступные чаты удаляются из БД
+
+# Несколько экземпляров бота: уведомления рассылает только лидер (аренда в общей БД)
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_NAME = 'notifications'
+LEASE_TTL = 30             # секунды: за это время лидерство переходит к другому экземпляру
+LEASE_HEARTBEAT = 10       # секунды между продлениями аренды
+SHARED_SNAPSHOT_TTL = 15   # как часто ведомые перечитывают снимок лидера из БД
+
+# Webhook вместо long polling (нужен, если экземпляров несколько: getUpdates допускает только одного)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Логирование: обработчики только кладут записи в очередь, в файл пишет отдельный поток
+LOG_CONTEXT = threading.local()
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи структурированные поля chat_id, handler и latency"""
+    def filter(self, record):
+        for field in ('chat_id', 'handler', 'latency'):
+            if not hasattr(record, field):
+                setattr(record, field, getattr(LOG_CONTEXT, field, '-'))
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Пропускает не больше LOG_SAMPLE_LIMIT записей с одного места в коде за LOG_SAMPLE_WINDOW"""
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.counters = {}  # (файл, строка, уровень) -> [начало окна, записано, пропущено]
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.time()
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or now - counter[0] >= LOG_SAMPLE_WINDOW:
+                suppressed = counter[2] if counter else 0
+                self.counters[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} (пропущено похожих записей: {suppressed})"
+                return True
+            if counter[1] < LOG_SAMPLE_LIMIT:
+                counter[1] += 1
+                return True
+            counter[2] += 1
+            return False
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование и трассировка — в потоке записи"""
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - '
+        '[chat_id=%(chat_id)s handler=%(handler)s latency=%(latency)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+
+    log_queue = queue.Queue(-1)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers = [queue_handler]
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+@contextmanager
+def handler_context(chat_id, handler):
+    """Привязывает chat_id и имя обработчика к записям лога и замеряет время обработки"""
+    LOG_CONTEXT.chat_id = chat_id
+    LOG_CONTEXT.handler = handler
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        latency = int((time.perf_counter() - started) * 1000)
+        level = logging.WARNING if latency >= SLOW_HANDLER_MS else logging.DEBUG
+        logging.log(level, "Обработка завершена", extra={'latency': f"{latency}ms"})
+        LOG_CONTEXT.chat_id = LOG_CONTEXT.handler = '-'
 
 # Локализация
 LOCALE = {
@@ -44,6 +214,7 @@ LOCALE = {
     'FISSURE_STORM': 'Буря Бездны',
     'BACK': '⬅️ Назад'
 }
+LOCALE['MENU'] += ['Вылазка 🎯', 'Охота на Архонта 🐺', 'Арбитраж ⚖️', 'Ночная волна 🌙', 'Циклы миров 🌗']
 
 # Переводы типов миссий
 MISSION_TYPES_TRANSLATION = {
@@ -78,6 +249,107 @@ TIER_TRANSLATION = {
 
 TIER_REVERSE_TRANSLATION = {v: k for k, v in TIER_TRANSLATION.items()}
 
+# Циклы открытых миров: точка отсчёта (начало первого состояния, UTC) и состояния с длительностью.
+# Точки отсчёта приблизительные — при каждом новом снимке они уточняются по expiry из API
+WORLD_CYCLES = {
+    'cetusCycle': {
+        'title': 'Равнины Эйдолона',
+        'epoch': 1510444800,
+        'states': [('day', 6000), ('night', 3000)]
+    },
+    'vallisCycle': {
+        'title': 'Долина Сфер',
+        'epoch': 1541837628,
+        'states': [('warm', 400), ('cold', 1200)]
+    },
+    'cambionCycle': {
+        'title': 'Камбионский Дрейф',
+        'epoch': 1510444800,
+        'states': [('fass', 6000), ('vome', 3000)]
+    },
+}
+
+CYCLE_STATE_TRANSLATION = {
+    'day': '☀️ День',
+    'night': '🌙 Ночь',
+    'warm': '🔥 Тепло',
+    'cold': '❄️ Холод',
+    'fass': '🟠 Фасс',
+    'vome': '🔵 Воум'
+}
+
+# Снимок состояния мира: разделы декодируются и проверяются при первом обращении
+SNAPSHOT_SECTIONS = {
+    'events': list,
+    'invasions': list,
+    'fissures': list,
+    'voidTraders': list,
+    'sortie': dict,
+    'archonHunt': dict,
+    'arbitration': dict,
+    'nightwave': dict,
+    'cetusCycle': dict,
+    'vallisCycle': dict,
+    'cambionCycle': dict,
+}
+
+class Snapshot:
+    """Обёртка над ответом API с ленивой проверкой и кэшированием разделов.
+
+    Поддерживает data.get(key, default), как обычный словарь. Текст ответа
+    декодируется при первом обращении, из него остаются только разделы из
+    SNAPSHOT_SECTIONS; каждый раздел проверяется один раз за снимок.
+    """
+
+    def __init__(self, payload):
+        self._payload = payload  # строка JSON или уже декодированный словарь
+        self._sections = {}
+        self._derived = {}
+        self._lock = threading.RLock()
+
+    def _raw(self):
+        if not isinstance(self._payload, dict):
+            try:
+                payload = json.loads(self._payload) if self._payload else {}
+            except (TypeError, ValueError) as e:
+                logging.error(f"Не удалось декодировать снимок: {e}")
+                payload = {}
+            if not isinstance(payload, dict):
+                payload = {}
+            # Храним только нужные разделы, остальной ответ не держим в памяти
+            self._payload = {key: payload[key] for key in SNAPSHOT_SECTIONS if key in payload}
+        return self._payload
+
+    def section(self, key):
+        """Проверенный раздел снимка или None, если его нет или формат неверный"""
+        with self._lock:
+            if key in self._sections:
+                return self._sections[key]
+            value = self._raw().get(key)
+            expected = SNAPSHOT_SECTIONS.get(key)
+            if value is not None and expected and not isinstance(value, expected):
+                logging.warning(f"Неверный формат данных для {key}: {type(value)}")
+                value = None
+            if isinstance(value, list):
+                value = [item for item in value if isinstance(item, dict)]
+            self._sections[key] = value
+            return value
+
+    def get(self, key, default=None):
+        value = self.section(key)
+        return default if value is None else value
+
+    def derived(self, name, factory):
+        """Кэширует производные данные (индексы и т.п.) на время жизни снимка"""
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = factory()
+            return self._derived[name]
+
+    def __bool__(self):
+        with self._lock:
+            return bool(self._raw())
+
 # Функции валидации данных
 def validate_api_data(data, key):
     if not data:
@@ -118,9 +390,58 @@ def is_data_valid(data):
     return True
 
 # Инициализация бота
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 bot = telebot.TeleBot(BOT_TOKEN)
 scheduler = BackgroundScheduler()
-logging.basicConfig(level=logging.INFO)
+
+# Маршрутизация текстовых сообщений: один обработчик telebot и поиск по словарю
+TEXT_ROUTES = {}     # точный текст кнопки -> обработчик
+COMMAND_ROUTES = {}  # команда без "/" -> обработчик
+PATTERN_ROUTES = []  # [(условие, обработчик)] проверяются по порядку, если точного совпадения нет
+
+def route_text(*texts):
+    def decorator(handler):
+        for text in texts:
+            TEXT_ROUTES[text] = handler
+        return handler
+    return decorator
+
+def route_command(*commands):
+    def decorator(handler):
+        for command in commands:
+            COMMAND_ROUTES[command] = handler
+        return handler
+    return decorator
+
+def route_pattern(predicate):
+    def decorator(handler):
+        PATTERN_ROUTES.append((predicate, handler))
+        return handler
+    return decorator
+
+def resolve_route(text):
+    """Находит обработчик для текста сообщения: команда, точный текст, затем шаблоны"""
+    if text.startswith('/'):
+        command = text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+        if command in COMMAND_ROUTES:
+            return COMMAND_ROUTES[command]
+    
+    handler = TEXT_ROUTES.get(text)
+    if handler:
+        return handler
+    
+    for predicate, handler in PATTERN_ROUTES:
+        if predicate(text):
+            return handler
+    return None
+
+@bot.message_handler(content_types=['text'])
+def dispatch_message(message):
+    handler = resolve_route(message.text or '')
+    if handler:
+        with handler_context(message.chat.id, handler.__name__):
+            handler(message)
 
 # Работа с базой данных
 def init_db():
@@ -134,6 +455,129 @@ def init_db():
                 fissure_filters TEXT DEFAULT '{"types": [], "tiers": [], "hard": false, "storm": false}'
             )
         ''')
+        # Миграция: новые колонки добавляются к уже существующей таблице
+        columns = {row[1] for row in c.execute("PRAGMA table_info(users)")}
+        if 'active' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+        if 'inactive_since' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN inactive_since REAL")
+        if 'quiet_start' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN quiet_start INTEGER")  # час по времени пользователя
+        if 'quiet_end' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN quiet_end INTEGER")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(active, chat_id)")
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL DEFAULT 0,
+                created REAL
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt)")
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS shared_snapshot (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                fetched REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS history_codes (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                UNIQUE (kind, value)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS baro_history (
+                uid INTEGER PRIMARY KEY,
+                location INTEGER NOT NULL,
+                activation INTEGER NOT NULL,
+                expiry INTEGER NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS watchlist (
+                chat_id INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                PRIMARY KEY (chat_id, term)
+            )
+        ''')
+        # Версии общих данных: экземпляры сверяют их, чтобы не держать устаревший кэш
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS versions (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        # Черновики фильтров в общей БД: нажатия одного чата могут попасть на разные экземпляры
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS filter_drafts (
+                chat_id INTEGER PRIMARY KEY,
+                filters TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS boards (
+                chat_id INTEGER PRIMARY KEY,
+                message_id INTEGER NOT NULL,
+                content_hash TEXT,
+                updated REAL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS presets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL UNIQUE,
+                title TEXT,
+                link TEXT,
+                fissure_filters TEXT NOT NULL
+            )
+        ''')
+        # О чём уже сообщили: переживает перезапуск и смену лидера
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS notified (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS notify_passes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fissures TEXT NOT NULL,
+                cursor INTEGER,
+                created REAL NOT NULL,
+                users INTEGER NOT NULL DEFAULT 0,
+                messages INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # Строка outbox с message_id — правка уже отправленного сообщения (табло), а не новое сообщение
+        if 'message_id' not in {row[1] for row in c.execute("PRAGMA table_info(outbox)")}:
+            c.execute("ALTER TABLE outbox ADD COLUMN message_id INTEGER")
+        # Сообщение о разрыве теряет смысл после его окончания: такие строки не отправляются
+        if 'expires' not in {row[1] for row in c.execute("PRAGMA table_info(outbox)")}:
+            c.execute("ALTER TABLE outbox ADD COLUMN expires REAL")
+        # Индекс (mission, tier, flags) не годился для запроса только по уровню
+        for (name,) in c.execute(
+            "SELECT tbl_name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_fissure_history_%_kind'"
+        ).fetchall():
+            c.execute(f"DROP INDEX idx_{name}_kind")
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_tier ON {name}(tier, flags, mission)")
         conn.commit()
 
 def check_db_structure():
@@ -143,7 +587,7 @@ def check_db_structure():
         print(c.fetchall())
 
 def get_user(chat_id):
-    logging.info(f"[get_user] Получен chat_id: {chat_id} (тип: {type(chat_id)})")
+    logging.debug(f"[get_user] Получен chat_id: {chat_id} (тип: {type(chat_id)})")
     
     # Если передан объект Message, извлекаем chat_id
     if isinstance(chat_id, telebot.types.Message):
@@ -181,8 +625,11 @@ def get_user(chat_id):
 def save_user(chat_id, data):
     with sqlite3.connect(DATABASE) as conn:
         c = conn.cursor()
+        # UPSERT, а не REPLACE: не затирает остальные колонки (active и т.п.)
         c.execute(
-            "REPLACE INTO users VALUES (?,?,?,?)", 
+            "INSERT INTO users (chat_id, timezone, subscriptions, fissure_filters) VALUES (?,?,?,?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET timezone=excluded.timezone, "
+            "subscriptions=excluded.subscriptions, fissure_filters=excluded.fissure_filters", 
             (
                 chat_id, 
                 data['timezone'], 
@@ -197,6 +644,446 @@ def save_user(chat_id, data):
         )
         conn.commit()
 
+def save_fissure_filters(chat_id, filters):
+    """Сохраняет только фильтры разрывов пользователя одной транзакцией"""
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "UPDATE users SET fissure_filters=? WHERE chat_id=?",
+            (json.dumps(filters), chat_id)
+        )
+        conn.commit()
+
+def set_chat_active(chat_id):
+    """Возвращает чат в рассылку (например, после /start)"""
+    with sqlite3.connect(DATABASE) as conn:
+        updated = conn.execute(
+            "UPDATE users SET active=1, inactive_since=NULL WHERE chat_id=? AND active=0", (chat_id,)
+        ).rowcount
+        if updated:
+            invalidate_watch_matcher(conn)  # списки наблюдения вернувшегося чата снова в работе
+        conn.commit()
+
+def mark_chat_inactive(chat_id):
+    """Исключает чат из рассылки: бот заблокирован, чат удалён или пользователь деактивирован"""
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "UPDATE users SET active=0, inactive_since=? WHERE chat_id=? AND active=1",
+            (time.time(), chat_id)
+        )
+        conn.execute("DELETE FROM outbox WHERE chat_id=?", (chat_id,))
+        invalidate_watch_matcher(conn)
+        conn.commit()
+    logging.info(f"Чат {chat_id} недоступен и исключён из рассылки")
+
+def disable_preset_channel(chat_id, reason):
+    """Удаляет пресеты канала, куда бот больше не может писать. False — это не канал пресета"""
+    with sqlite3.connect(DATABASE) as conn:
+        titles = [row[0] for row in conn.execute("SELECT title FROM presets WHERE channel_id=?", (chat_id,))]
+        if not titles:
+            return False
+        conn.execute("DELETE FROM presets WHERE channel_id=?", (chat_id,))
+        conn.execute("DELETE FROM outbox WHERE chat_id=?", (chat_id,))
+        conn.commit()
+    logging.warning(f"Пресет канала {titles[0]} ({chat_id}) отключён: {reason}")
+    enqueue_messages([
+        (admin_id, f"⚠️ Пресет канала {titles[0]} отключён: бот не может туда писать ({reason})", None)
+        for admin_id in ADMIN_IDS
+    ])
+    return True
+
+def purge_inactive_chats():
+    """Удаляет чаты, недоступные дольше INACTIVE_RETENTION_DAYS (фоновая задача лидера)"""
+    if not is_leader():
+        return
+    cutoff = time.time() - INACTIVE_RETENTION_DAYS * 86400
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "DELETE FROM watchlist WHERE chat_id IN "
+            "(SELECT chat_id FROM users WHERE active=0 AND inactive_since < ?)", (cutoff,)
+        )
+        conn.execute(
+            "DELETE FROM boards WHERE chat_id IN "
+            "(SELECT chat_id FROM users WHERE active=0 AND inactive_since < ?)", (cutoff,)
+        )
+        deleted = conn.execute("DELETE FROM users WHERE active=0 AND inactive_since < ?", (cutoff,)).rowcount
+        if deleted:
+            invalidate_watch_matcher(conn)
+        conn.commit()
+    if deleted:
+        logging.info(f"Удалено недоступных чатов: {deleted}")
+
+# Черновики фильтров разрывов: нажатия пишутся в маленькую общую таблицу filter_drafts,
+# а строка users переписывается один раз — при сохранении или по истечении FILTER_DRAFT_TTL
+def read_filter_draft(conn, chat_id):
+    """Фильтры из черновика чата, а без черновика — сохранённые. None — пользователь не найден"""
+    row = conn.execute(
+        "SELECT COALESCE(d.filters, u.fissure_filters) FROM users u "
+        "LEFT JOIN filter_drafts d ON d.chat_id = u.chat_id WHERE u.chat_id=?", (chat_id,)
+    ).fetchone()
+    if not row:
+        return None
+    try:
+        filters = json.loads(row[0]) if row[0] else None
+    except json.JSONDecodeError:
+        filters = None
+    if not isinstance(filters, dict):
+        filters = {"types": [], "tiers": [], "hard": False, "storm": False}
+    return filters
+
+def get_filter_draft(chat_id):
+    """Текущие фильтры чата с учётом несохранённых изменений"""
+    with sqlite3.connect(DATABASE) as conn:
+        return read_filter_draft(conn, chat_id)
+
+def update_filter_draft(chat_id, change):
+    """Применяет change(filters) -> filters к черновику и продлевает его.
+
+    Чтение и запись идут в одной транзакции BEGIN IMMEDIATE, поэтому нажатия,
+    попавшие на разные экземпляры, не затирают друг друга.
+    """
+    conn = sqlite3.connect(DATABASE, timeout=10, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        filters = read_filter_draft(conn, chat_id)
+        if filters is not None:
+            filters = change(filters)
+            conn.execute(
+                "REPLACE INTO filter_drafts (chat_id, filters, expires) VALUES (?,?,?)",
+                (chat_id, json.dumps(filters), time.time() + FILTER_DRAFT_TTL)
+            )
+        conn.execute("COMMIT")
+        return filters
+    finally:
+        conn.close()
+
+def discard_filter_draft(chat_id):
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute("DELETE FROM filter_drafts WHERE chat_id=?", (chat_id,))
+        conn.commit()
+
+def commit_filter_drafts(condition, params=()):
+    """Переносит подходящие черновики в users и удаляет их одной транзакцией"""
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "UPDATE users SET fissure_filters="
+            "(SELECT filters FROM filter_drafts d WHERE d.chat_id = users.chat_id) "
+            f"WHERE chat_id IN (SELECT chat_id FROM filter_drafts WHERE {condition})", params
+        )
+        committed = conn.execute(f"DELETE FROM filter_drafts WHERE {condition}", params).rowcount
+        conn.commit()
+    return committed
+
+def commit_filter_draft(chat_id):
+    """Записывает черновик чата в users (если он есть) и закрывает его"""
+    return commit_filter_drafts("chat_id=?", (chat_id,))
+
+def commit_expired_filter_drafts():
+    """Автоматически сохраняет черновики, которые не менялись дольше FILTER_DRAFT_TTL"""
+    try:
+        commit_filter_drafts("expires <= ?", (time.time(),))
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка автосохранения фильтров: {e}", exc_info=True)
+
+# Очередь исходящих сообщений (outbox)
+OUTBOX_WAKEUP = threading.Event()
+
+def enqueue_messages(messages, urgent=True, conn=None):
+    """Сохраняет сообщения [(chat_id, text, parse_mode[, expires]), ...] в очередь одной транзакцией.
+
+    expires (UTC timestamp) — когда сообщение устаревает; REMAINING_PLACEHOLDER
+    в тексте заменяется оставшимся до expires временем при отправке.
+
+    Несрочные сообщения проходят через plan_deliveries: откладываются на конец
+    тихих часов пользователя и распределяются по окну DELIVERY_WINDOW.
+    Если передано соединение conn, вставка идёт в его транзакцию (фиксирует вызывающий).
+    """
+    if not messages:
+        return
+    now = time.time()
+    send_times = [now] * len(messages) if urgent else plan_deliveries(messages, now)
+    rows = [
+        (chat_id, text, parse_mode, send_at, now, expires[0] if expires else None)
+        for (chat_id, text, parse_mode, *expires), send_at in zip(messages, send_times)
+    ]
+    insert = "INSERT INTO outbox (chat_id, text, parse_mode, next_attempt, created, expires) VALUES (?,?,?,?,?,?)"
+    if conn is not None:
+        conn.executemany(insert, rows)
+    else:
+        with sqlite3.connect(DATABASE) as conn:
+            conn.executemany(insert, rows)
+            conn.commit()
+    OUTBOX_WAKEUP.set()
+
+def parse_timezone(timezone):
+    """Часовой пояс из users.timezone: IANA-название или смещение, сохранённое /custom_timezone"""
+    # custom_timezone хранит str(pytz.FixedOffset(...)) — "pytz.FixedOffset(180)", pytz.timezone его не понимает
+    match = re.fullmatch(r'pytz\.FixedOffset\((-?\d+)\)', timezone or '')
+    if match:
+        return pytz.FixedOffset(int(match.group(1)))
+    try:
+        return pytz.timezone(timezone)
+    except pytz.UnknownTimeZoneError:
+        return pytz.utc
+
+def quiet_hours_end(timezone, quiet_start, quiet_end, moment):
+    """Если moment (UTC timestamp) попадает в тихие часы пользователя — время их окончания, иначе None"""
+    tz = parse_timezone(timezone)
+    local = datetime.fromtimestamp(moment, tz)
+    if quiet_start < quiet_end:
+        is_quiet = quiet_start <= local.hour < quiet_end
+    else:
+        is_quiet = local.hour >= quiet_start or local.hour < quiet_end  # через полночь, например 23-8
+    if not is_quiet:
+        return None
+    
+    end = tz.localize(datetime.combine(local.date(), datetime.min.time()).replace(hour=quiet_end))
+    if end.timestamp() <= moment:
+        end = tz.localize(datetime.combine(local.date() + timedelta(days=1), datetime.min.time()).replace(hour=quiet_end))
+    return end.timestamp()
+
+def plan_deliveries(messages, now):
+    """Назначает время отправки: равномерно по DELIVERY_WINDOW, с учётом тихих часов"""
+    chat_ids = list({chat_id for chat_id, *_ in messages})
+    quiet = {}
+    with sqlite3.connect(DATABASE) as conn:
+        for i in range(0, len(chat_ids), 500):
+            chunk = chat_ids[i:i + 500]
+            rows = conn.execute(
+                "SELECT chat_id, timezone, quiet_start, quiet_end FROM users "
+                f"WHERE quiet_start IS NOT NULL AND chat_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for chat_id, timezone, quiet_start, quiet_end in rows:
+                quiet[chat_id] = (timezone, quiet_start, quiet_end)
+    
+    step = DELIVERY_WINDOW / len(messages)
+    offsets = [i * step for i in range(len(messages))]
+    random.shuffle(offsets)  # порядок получателей в окне случайный
+    
+    send_times = []
+    for (chat_id, *_), offset in zip(messages, offsets):
+        send_at = now + offset
+        if chat_id in quiet:
+            quiet_end = quiet_hours_end(*quiet[chat_id], send_at)
+            if quiet_end:
+                # Отложенные сообщения тоже размазываем, чтобы не было всплеска в конце тихих часов
+                send_at = quiet_end + offset
+        send_times.append(send_at)
+    return send_times
+
+def is_chat_unreachable(error):
+    """Ошибки Telegram, после которых писать в чат бессмысленно"""
+    description = (error.description or '').lower()
+    if error.error_code == 403:
+        return True  # бот заблокирован/исключён, пользователь деактивирован
+    return error.error_code == 400 and ('chat not found' in description or 'user not found' in description)
+
+def get_retry_after(error):
+    """Извлекает retry_after (секунды) из ответа Telegram с кодом 429"""
+    try:
+        return int(error.result_json.get('parameters', {}).get('retry_after', 1))
+    except (AttributeError, TypeError, ValueError):
+        return 1
+
+def process_outbox():
+    """Отправляет готовые сообщения из очереди. Возвращает паузу (секунды) до следующего прохода"""
+    now = time.time()
+    with sqlite3.connect(DATABASE) as conn:
+        rows = conn.execute(
+            "SELECT id, chat_id, text, parse_mode, attempts, message_id, expires FROM outbox "
+            "WHERE next_attempt <= ? ORDER BY next_attempt, id LIMIT ?",
+            (now, OUTBOX_BATCH_SIZE)
+        ).fetchall()
+
+        unreachable = set()
+        for msg_id, chat_id, text, parse_mode, attempts, message_id, expires in rows:
+            if not is_leader():
+                break  # аренда истекла посреди пачки: остаток отправит новый лидер
+            if chat_id in unreachable:
+                continue  # сообщения уже удалены mark_chat_inactive
+            if expires:
+                left = expires - time.time()
+                if left <= 0:
+                    # Например, пролежало в очереди все тихие часы: разрыв уже закрылся
+                    conn.execute("DELETE FROM outbox WHERE id=?", (msg_id,))
+                    conn.commit()
+                    continue
+                text = text.replace(REMAINING_PLACEHOLDER, format_duration(left))
+            try:
+                if message_id:
+                    bot.edit_message_text(text, chat_id, message_id, parse_mode=parse_mode)
+                else:
+                    bot.send_message(chat_id, text, parse_mode=parse_mode)
+                conn.execute("DELETE FROM outbox WHERE id=?", (msg_id,))
+                conn.commit()
+                time.sleep(1 / OUTBOX_MAX_RATE)  # ровный темп вместо всплесков
+                continue
+
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Telegram просит подождать: откладываем всю очередь
+                    retry_after = get_retry_after(e)
+                    logging.warning(f"Превышен лимит Telegram, пауза {retry_after} с")
+                    conn.execute(
+                        "UPDATE outbox SET next_attempt=? WHERE next_attempt < ?",
+                        (time.time() + retry_after, time.time() + retry_after)
+                    )
+                    conn.commit()
+                    return retry_after
+                if is_chat_unreachable(e) or 'rights' in (e.description or '').lower():
+                    if disable_preset_channel(chat_id, e.description):
+                        unreachable.add(chat_id)
+                        continue
+                if is_chat_unreachable(e):
+                    unreachable.add(chat_id)
+                    mark_chat_inactive(chat_id)
+                    continue
+                if e.error_code < 500:
+                    # Ошибка запроса (400): повтор не поможет
+                    logging.warning(f"Сообщение для {chat_id} отброшено: {e.description}")
+                    conn.execute("DELETE FROM outbox WHERE id=?", (msg_id,))
+                    if message_id and 'message to edit not found' in (e.description or '').lower():
+                        # Сообщение табло удалено в чате: больше его не обновляем
+                        conn.execute("DELETE FROM boards WHERE chat_id=? AND message_id=?", (chat_id, message_id))
+                    conn.commit()
+                    continue
+                error = e
+
+            except (requests.exceptions.RequestException, telebot.apihelper.ApiException) as e:
+                error = e
+
+            # Временная ошибка: повтор с экспоненциальной задержкой
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logging.error(f"Сообщение для {chat_id} отброшено после {attempts} попыток: {error}")
+                conn.execute("DELETE FROM outbox WHERE id=?", (msg_id,))
+            else:
+                backoff = OUTBOX_BASE_BACKOFF * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+                logging.warning(f"Ошибка отправки для {chat_id} (попытка {attempts}): {error}")
+                conn.execute(
+                    "UPDATE outbox SET attempts=?, next_attempt=? WHERE id=?",
+                    (attempts, time.time() + backoff, msg_id)
+                )
+            conn.commit()
+
+        if len(rows) == OUTBOX_BATCH_SIZE:
+            return 0
+        # Просыпаемся к ближайшему запланированному сообщению
+        next_attempt = conn.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0]
+    if next_attempt is None:
+        return OUTBOX_POLL_INTERVAL
+    return min(max(next_attempt - time.time(), 1 / OUTBOX_MAX_RATE), OUTBOX_POLL_INTERVAL)
+
+def outbox_worker():
+    """Фоновый поток: отправляет сообщения из очереди, в том числе оставшиеся после перезапуска"""
+    while True:
+        try:
+            # Очередь общая для всех экземпляров, разбирает её только лидер
+            delay = process_outbox() if is_leader() else LEASE_HEARTBEAT
+        except Exception as e:
+            logging.error(f"Ошибка обработки очереди сообщений: {e}", exc_info=True)
+            delay = OUTBOX_POLL_INTERVAL
+        if delay:
+            OUTBOX_WAKEUP.wait(delay)
+        OUTBOX_WAKEUP.clear()
+
+# Лидерство: фоновые задачи (запросы к API, рассылка) выполняет только один экземпляр
+IS_LEADER = False
+LEASE_EXPIRES = 0          # до какого момента действует наша аренда (UTC timestamp)
+LEASE_LOCK = threading.Lock()
+
+def is_leader():
+    """Лидер с неистёкшей арендой: если продление задержалось, аренду уже мог забрать другой экземпляр"""
+    return IS_LEADER and time.time() < LEASE_EXPIRES
+
+def renew_leadership():
+    """Захватывает или продлевает аренду лидера; вызывается по расписанию каждые LEASE_HEARTBEAT"""
+    with LEASE_LOCK:
+        _renew_leadership()
+
+def _renew_leadership():
+    global IS_LEADER, LEASE_EXPIRES
+    now = time.time()
+    holder_expires = None
+    try:
+        conn = sqlite3.connect(DATABASE, timeout=10, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, expires FROM leases WHERE name=?", (LEASE_NAME,)).fetchone()
+            leader = row is None or row[0] == INSTANCE_ID or row[1] < now
+            if leader:
+                conn.execute(
+                    "REPLACE INTO leases (name, holder, expires) VALUES (?,?,?)",
+                    (LEASE_NAME, INSTANCE_ID, now + LEASE_TTL)
+                )
+            else:
+                holder_expires = row[1]
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        # Не смогли продлить аренду — считаем, что лидерство потеряно
+        logging.error(f"Ошибка продления аренды лидера: {e}")
+        leader = False
+
+    if leader:
+        LEASE_EXPIRES = now + LEASE_TTL
+    elif holder_expires:
+        # Пробуем забрать аренду сразу, как она истечёт, а не на следующем продлении:
+        # так смена лидера занимает не больше LEASE_TTL
+        scheduler.add_job(
+            renew_leadership, 'date',
+            run_date=datetime.fromtimestamp(holder_expires, pytz.utc) + timedelta(milliseconds=100),
+            id=LEASE_TAKEOVER_JOB_ID, replace_existing=True, misfire_grace_time=None
+        )
+
+    if leader and not IS_LEADER:
+        logging.info(f"Экземпляр {INSTANCE_ID} стал лидером")
+        IS_LEADER = True
+        load_notified_state()  # о чём уже сообщил прежний лидер
+        scheduler.add_job(check_notifications, id=NOTIFY_JOB_ID, replace_existing=True, misfire_grace_time=None)
+        OUTBOX_WAKEUP.set()
+    elif not leader and IS_LEADER:
+        logging.warning(f"Экземпляр {INSTANCE_ID} потерял лидерство")
+        IS_LEADER = False
+        if scheduler.get_job(NOTIFY_JOB_ID):
+            scheduler.remove_job(NOTIFY_JOB_ID)
+
+def release_leadership():
+    """Освобождает аренду при остановке, чтобы другой экземпляр не ждал LEASE_TTL"""
+    if not is_leader():
+        return
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (LEASE_NAME, INSTANCE_ID))
+        conn.commit()
+
+def save_shared_snapshot(payload, fetched):
+    """Лидер сохраняет сырой ответ API, чтобы ведомые читали его без запросов к API"""
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "REPLACE INTO shared_snapshot (id, fetched, payload) VALUES (1, ?, ?)",
+            (fetched, payload)
+        )
+        conn.commit()
+
+def load_shared_snapshot():
+    """Ведомый экземпляр берёт снимок лидера из БД (декодирует только новый)"""
+    try:
+        with sqlite3.connect(DATABASE) as conn:
+            row = conn.execute("SELECT fetched FROM shared_snapshot WHERE id=1").fetchone()
+            if row and row[0] != CACHE.get('fetched'):
+                row = conn.execute("SELECT fetched, payload FROM shared_snapshot WHERE id=1").fetchone()
+                data = Snapshot(row[1])
+                CACHE.update({'data': data, 'fetched': row[0]})
+                resync_world_cycles(data)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка чтения общего снимка: {e}")
+    
+    CACHE['expires'] = datetime.now() + timedelta(seconds=SHARED_SNAPSHOT_TTL)
+    return CACHE.get('data', {})
+
 # Глобальный кэш
 CACHE = {}
 
@@ -208,27 +1095,200 @@ def is_cache_valid():
         datetime.now() < CACHE.get('expires', datetime.min)
     )
 
-# Получение данных из API
-def get_api_data():
-    global CACHE
-    if is_cache_valid():
-        return CACHE['data']
+class UpstreamUnavailable(Exception):
+    """Предохранитель разомкнут: запрос к API не выполнялся"""
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев или медленных ответов и пропускает пробные запросы по одному.
+
+    closed    — запросы идут как обычно;
+    open      — запросы не выполняются до истечения паузы (экспоненциальной, со случайным разбросом);
+    half_open — пропускается ровно один пробный запрос, его исход замыкает или снова размыкает цепь.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0           # размыканий подряд, от них растёт пауза
+        self.open_until = 0
+        self.probe_in_flight = False
+        self.last_error = None
+        self.last_latency = None
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() >= self.open_until:
+                self.state = 'half_open'
+                self.probe_in_flight = False
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self, latency):
+        if latency > BREAKER_LATENCY_BUDGET:
+            self.record_failure(f"медленный ответ: {latency:.1f} с")
+            return
+        with self.lock:
+            if self.state != 'closed':
+                logging.info("Предохранитель API замкнут")
+            self.state = 'closed'
+            self.failures = 0
+            self.trips = 0
+            self.probe_in_flight = False
+            self.last_latency = latency
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self.probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                cooldown = min(BREAKER_BASE_COOLDOWN * 2 ** self.trips, BREAKER_MAX_COOLDOWN)
+                cooldown *= random.uniform(0.5, 1.5)
+                self.trips += 1
+                self.state = 'open'
+                self.open_until = time.time() + cooldown
+                logging.warning(f"Предохранитель API разомкнут на {int(cooldown)} с: {error}")
+
+    def status(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': max(int(self.open_until - time.time()), 0) if self.state == 'open' else 0,
+                'last_error': self.last_error,
+                'last_latency': self.last_latency
+            }
+
+UPSTREAM_BREAKER = CircuitBreaker()
+FETCH_LOCK = threading.Lock()  # одновременно к API идёт только один запрос
+
+def fetch_worldstate():
+    """Запрашивает состояние мира через предохранитель; возвращает содержимое ответа AllOrigins"""
+    if not UPSTREAM_BREAKER.allow_request():
+        raise UpstreamUnavailable(f"предохранитель разомкнут: {UPSTREAM_BREAKER.status()['state']}")
+    
+    started = time.time()
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
         }
-        response = requests.get(API_URL, timeout=20, headers=headers)
+        response = requests.get(API_URL, timeout=UPSTREAM_TIMEOUT, headers=headers)
         response.raise_for_status()
-        data = response.json()['contents']  # Извлекаем содержимое через AllOrigins
+        payload = response.json()['contents']  # Извлекаем содержимое через AllOrigins
+        if not payload:
+            raise ValueError("пустой ответ API")
+    except Exception as e:
+        UPSTREAM_BREAKER.record_failure(e)
+        raise
+    
+    UPSTREAM_BREAKER.record_success(time.time() - started)
+    return payload
+
+# Получение данных из API
+def get_api_data(force=False):
+    global CACHE
+    if not force and is_cache_valid():
+        return CACHE['data']
+    if not is_leader():
+        return load_shared_snapshot()
+    
+    # Если запрос уже идёт, а старый снимок есть — не держим поток обработчика, отдаём старый
+    requested = time.time()
+    if not FETCH_LOCK.acquire(blocking=force or 'data' not in CACHE):
+        return CACHE['data']
+    try:
+        # Пока ждали, снимок мог обновить другой поток
+        if CACHE.get('fetched', 0) >= requested or (not force and is_cache_valid()):
+            return CACHE['data']
+        
+        payload = fetch_worldstate()
+        # AllOrigins возвращает тело ответа строкой, разделы декодируются по требованию
+        fetched = time.time()
+        data = Snapshot(payload)
         CACHE.update({
             'data': data,
+            'fetched': fetched,
             'expires': datetime.now() + timedelta(seconds=CACHE_TIMEOUT)
         })
+        save_shared_snapshot(payload, fetched)
+        resync_world_cycles(data)
         return data
+    except UpstreamUnavailable as e:
+        logging.warning(f"API недоступен, используется последний снимок: {e}")
+        return CACHE.get('data', {})
     except Exception as e:
         logging.error(f"Ошибка API: {e}", exc_info=True)
-        return {}
+        return CACHE.get('data', {})  # последний удачный снимок лучше, чем ничего
+    finally:
+        FETCH_LOCK.release()
+
+class TokenBucket:
+    """Ведро токенов: capacity запросов подряд, один токен восстанавливается за refill секунд"""
+
+    def __init__(self, capacity, refill):
+        self.capacity = capacity
+        self.refill = refill
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def _update(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.refill)
+        self.updated = now
+
+    def take(self, now):
+        self._update(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def give_back(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self, now):
+        self._update(now)
+        return max(0, (1 - self.tokens) * self.refill)
+
+class CommandRateLimiter:
+    """Лимит на чат и общий лимит; администраторы из ADMIN_IDS не ограничиваются"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats = {}
+        self.total = TokenBucket(GLOBAL_BUCKET_CAPACITY, GLOBAL_BUCKET_REFILL)
+
+    def acquire(self, chat_id):
+        """Возвращает 0, если запрос разрешён, иначе сколько секунд подождать"""
+        if chat_id in ADMIN_IDS:
+            return 0
+        now = time.time()
+        with self.lock:
+            if len(self.chats) > 10000:
+                # Полные вёдра ничего не помнят — их можно выбросить
+                self.chats = {cid: b for cid, b in self.chats.items() if b.wait_time(now) > 0}
+            bucket = self.chats.setdefault(chat_id, TokenBucket(CHAT_BUCKET_CAPACITY, CHAT_BUCKET_REFILL))
+            if not bucket.take(now):
+                return bucket.wait_time(now)
+            if not self.total.take(now):
+                bucket.give_back()
+                return self.total.wait_time(now)
+            return 0
+
+UPSTREAM_COMMAND_LIMITER = CommandRateLimiter()
+
+def check_command_rate(message):
+    """Отвечает пользователю и возвращает False, если лимит команд исчерпан"""
+    wait = UPSTREAM_COMMAND_LIMITER.acquire(message.chat.id)
+    if wait:
+        bot.send_message(message.chat.id, f"Слишком часто. Попробуйте через {int(wait) + 1} с")
+        return False
+    return True
 
 def check_api_update():
     try:
@@ -239,11 +1299,20 @@ def check_api_update():
     except Exception as e:
         logging.warning(f"Ошибка проверки API: {e}")
 
-@bot.message_handler(commands=['test_api'])
+@route_command('test_api')
 def test_api(message):
+    if not check_command_rate(message):
+        return
     try:
-        response = requests.get(API_URL, timeout=10)
-        bot.send_message(message.chat.id, f"Статус: {response.status_code}\nОтвет: {response.text[:200]}...")
+        started = time.time()
+        payload = fetch_worldstate()
+        bot.send_message(
+            message.chat.id,
+            f"Ответ за {time.time() - started:.1f} с\nОтвет: {str(payload)[:200]}..."
+        )
+    except UpstreamUnavailable:
+        status = UPSTREAM_BREAKER.status()
+        bot.send_message(message.chat.id, f"API недоступен, следующая проба через {status['retry_in']} с\nОшибка: {status['last_error']}")
     except Exception as e:
         bot.send_message(message.chat.id, f"Ошибка: {e}")
 
@@ -286,6 +1355,41 @@ def format_date(timestamp, timezone):
         logging.error(f"Критическая ошибка форматирования даты: {e}", exc_info=True)
         return "Ошибка времени"
 
+def parse_api_date(timestamp):
+    """Преобразует ISO-строку из API в datetime с часовым поясом (или None)"""
+    if not isinstance(timestamp, str):
+        return None
+    try:
+        dt = date_parser.isoparse(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else pytz.utc.localize(dt)
+
+def is_expired(item, now=None):
+    """Закончился ли элемент снимка к моменту now (элементы без expiry не заканчиваются)"""
+    expiry = parse_api_date(item.get('expiry'))
+    return bool(expiry and expiry <= (now or datetime.now(pytz.utc)))
+
+def format_remaining(timestamp, now=None):
+    """Время до timestamp из API, посчитанное в момент показа, а не в момент загрузки снимка"""
+    dt = parse_api_date(timestamp)
+    if not dt:
+        return 'Неизвестно'
+    return format_duration((dt - (now or datetime.now(pytz.utc))).total_seconds())
+
+def estimate_invasion_remaining(invasion, now=None):
+    """Оценка времени до конца вторжения по прогрессу (как в API): у вторжений нет expiry.
+
+    count — перевес побед одной из сторон (знак — какой), requiredRuns — сколько нужно для победы.
+    """
+    activation = parse_api_date(invasion.get('activation'))
+    count = abs(invasion.get('count') or 0)
+    required = invasion.get('requiredRuns') or 0
+    if not activation or not 0 < count < required:
+        return invasion.get('eta', 'Неизвестно')
+    elapsed = ((now or datetime.now(pytz.utc)) - activation).total_seconds()
+    return f"≈{format_duration((required - count) * elapsed / count)}"
+
 # Меню
 def create_main_menu():
     markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -293,7 +1397,7 @@ def create_main_menu():
     markup.add(*buttons)
     return markup
 
-@bot.message_handler(func=lambda m: m.text == 'Настройки ⚙️')
+@route_text('Настройки ⚙️')
 def settings_menu(message):
     try:
         chat_id = message.chat.id if isinstance(message, telebot.types.Message) else int(message)
@@ -318,19 +1422,23 @@ def settings_menu(message):
         logging.error(f"Ошибка в settings_menu: {e}", exc_info=True)
         bot.send_message(message.chat.id, "Произошла ошибка при открытии настроек")
 
-def create_subscriptions_menu(chat_id):
-    markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-    user = get_user(chat_id)
-    user_subs = user['subscriptions'] if user else []  # ✅ Уже список
+SUBSCRIPTION_CATEGORIES = ['events', 'invasions', 'fissures']
 
-    categories = ['events', 'invasions', 'fissures']
-    for cat in categories:
+def create_subscriptions_menu(subscriptions):
+    """Возвращает клавиатуру подписок для переданного списка подписок"""
+    return _subscriptions_markup(frozenset(subscriptions or []))
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _subscriptions_markup(user_subs):
+    markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    for cat in SUBSCRIPTION_CATEGORIES:
         markup.add(telebot.types.InlineKeyboardButton(
             text=f"{'✅' if cat in user_subs else '❌'} {cat}",
             callback_data=f"toggle_{cat}"
         ))
     
-    return markup
+    # Храним готовый JSON: telebot передаёт строку в API без повторной сериализации
+    return markup.to_json()
 
 # Форматирование наград
 def format_rewards(rewards):
@@ -346,100 +1454,294 @@ def format_rewards(rewards):
     return ', '.join(reward_items)
 
 # Уведомления
+# id разрывов, о которых уже сообщили (чтобы частые проверки не дублировали уведомления).
+# Копия таблицы notified: загружается при получении лидерства и после каждой записи
+NOTIFIED_FISSURES = set()
+NOTIFIED_WATCH_ITEMS = set()  # (предмет, источник) из прошлого снимка
+
+def load_notified_state():
+    """Перечитывает из БД, о каких разрывах и предметах уже сообщили"""
+    global NOTIFIED_FISSURES, NOTIFIED_WATCH_ITEMS
+    try:
+        with sqlite3.connect(DATABASE) as conn:
+            rows = conn.execute("SELECT kind, key FROM notified WHERE expires >= ?", (time.time(),)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка чтения отметок об уведомлениях: {e}")
+        return
+    NOTIFIED_FISSURES = {key for kind, key in rows if kind == 'fissure'}
+    NOTIFIED_WATCH_ITEMS = {tuple(json.loads(key)) for kind, key in rows if kind == 'watch'}
+
+def get_next_change(data, now=None):
+    """Возвращает ближайшее будущее время активации/окончания в снимке (UTC) или None"""
+    now = now or datetime.now(pytz.utc)
+    items = (
+        validate_api_data(data, 'fissures')
+        + validate_api_data(data, 'invasions')
+        + validate_api_data(data, 'voidTraders')
+    )
+
+    next_change = None
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        for key in ('activation', 'expiry'):
+            dt = parse_api_date(item.get(key))
+            if dt and dt > now and (next_change is None or dt < next_change):
+                next_change = dt
+    return next_change
+
+def schedule_next_check(data):
+    """Планирует следующую проверку сразу после ожидаемого изменения снимка"""
+    now = datetime.now(pytz.utc)
+    next_change = get_next_change(data, now) if data else None
+
+    delay = MAX_CHECK_INTERVAL
+    if next_change:
+        delay = (next_change - now).total_seconds() + CHECK_DELAY
+    delay = min(max(delay, MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+
+    scheduler.add_job(
+        check_notifications, 'date',
+        run_date=now + timedelta(seconds=delay),
+        id=NOTIFY_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+    logging.info(f"Следующая проверка уведомлений через {int(delay)} с")
+
 def check_notifications():
     """Проверяет события, вторжения и разрывы Бездны для всех пользователей"""
-    data = get_api_data()
-    
+    if not is_leader():
+        return  # цепочку проверок запустит renew_leadership, когда экземпляр станет лидером
+    data = {}
+    try:
+        data = get_api_data(force=True)
+        notify_users(data)
+        if not run_notify_passes():
+            schedule_notify_resume()
+        update_boards(data)
+        record_history(data)
+    except Exception as e:
+        logging.error(f"Ошибка проверки уведомлений: {e}", exc_info=True)
+    finally:
+        schedule_next_check(data)
+
+def notify_users(data):
+    """Рассылает уведомления о новых разрывах Бездны и предметах из списков наблюдения"""
     if not is_data_valid(data):
         logging.warning("Получены устаревшие или неполные данные")
         return
-    
+
+    fissures = validate_api_data(data, 'fissures')
+    new_fissures = open_fissures_with_expiry([f for f in fissures if f.get('id') not in NOTIFIED_FISSURES])
+    watch_items = list(dict.fromkeys(iter_snapshot_items(data)))
+    watch_messages = collect_watchlist_messages([entry for entry in watch_items if entry not in NOTIFIED_WATCH_ITEMS])
+    # Каналы пресетов — по одному сообщению на разрыв, без тихих часов и растягивания по окну
+    preset_messages = collect_preset_messages(new_fissures) if new_fissures else []
+
+    # Одной транзакцией: проход рассылки, сообщения и отметки "уже сообщили".
+    # После сбоя или смены лидера те же разрывы и предметы не разошлются повторно
+    now = time.time()
     with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        c.execute("SELECT chat_id, timezone, subscriptions, fissure_filters FROM users")
-        
-        for row in c.fetchall():
+        if new_fissures:
+            # Подписчиков обходит run_notify_passes — порциями и с сохранением курсора
+            conn.execute(
+                "INSERT INTO notify_passes (fissures, created) VALUES (?, ?)",
+                (json.dumps(new_fissures), now)
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO notified (kind, key, expires) VALUES ('fissure', ?, ?)",
+            [(fissure['id'], expires or now + NOTIFIED_DEFAULT_TTL) for fissure, expires in new_fissures if fissure.get('id')]
+        )
+        # Предметы помним только из текущего снимка, как и раньше
+        conn.execute("DELETE FROM notified WHERE kind='watch'")
+        conn.executemany(
+            "INSERT OR REPLACE INTO notified (kind, key, expires) VALUES ('watch', ?, ?)",
+            [(json.dumps(entry, ensure_ascii=False), now + NOTIFIED_DEFAULT_TTL) for entry in watch_items]
+        )
+        conn.execute("DELETE FROM notified WHERE expires < ?", (now,))
+        enqueue_messages(watch_messages, urgent=False, conn=conn)
+        enqueue_messages(preset_messages, conn=conn)
+        conn.commit()
+    OUTBOX_WAKEUP.set()
+    load_notified_state()
+
+def fissure_matches_filters(fissure, fissure_filters):
+    """Проверяет разрыв по фильтрам пользователя (пустой фильтр пропускает всё)"""
+    type_ok = not fissure_filters.get('types') or fissure.get('missionType') in fissure_filters['types']
+
+    # Используем обратный перевод для уровней
+    tier = fissure.get('tier')
+    tier_ok = not fissure_filters.get('tiers') or TIER_REVERSE_TRANSLATION.get(tier, tier) in fissure_filters['tiers']
+
+    # Проверка флагов
+    hard_ok = not fissure_filters.get('hard') or fissure.get('isHard', False) == fissure_filters['hard']
+    storm_ok = not fissure_filters.get('storm') or fissure.get('isStorm', False) == fissure_filters['storm']
+    return type_ok and tier_ok and hard_ok and storm_ok
+
+def open_fissures_with_expiry(fissures):
+    """[(разрыв, expires)] для ещё открытых разрывов: окончание разбирается один раз, а не для каждого получателя"""
+    now = datetime.now(pytz.utc)
+    return [
+        (fissure, expiry.timestamp() if expiry else None)
+        for fissure, expiry in ((f, parse_api_date(f.get('expiry'))) for f in fissures)
+        if not expiry or expiry > now
+    ]
+
+def format_fissure_alert(fissure, expires):
+    mission_type = fissure.get('missionType')
+    tier = fissure.get('tier')
+    return (
+        f"⚡ Разрыв Бездны: {fissure.get('node', 'Неизвестно')}\n"
+        f"Тип: {MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)}\n"
+        f"Уровень: {TIER_TRANSLATION.get(tier, tier)}\n"
+        f"⏳ Осталось: {REMAINING_PLACEHOLDER if expires else 'Неизвестно'}"
+    )
+
+def collect_fissure_messages(new_fissures, users):
+    """Подбирает новые разрывы [(разрыв, expires)] под фильтры подписчиков из порции users"""
+    messages = []
+    for row in users:
+        try:
+            chat_id, tz, subs, filters_str = row
+            
+            # Извлечение подписок
             try:
-                chat_id, tz, subs, filters_str = row
-                
-                # Извлечение подписок
-                try:
-                    subscriptions = subs.split(',') if isinstance(subs, str) and subs else []
-                except:
-                    subscriptions = []
-                
-                # Извлечение и парсинг фильтров
-                try:
-                    fissure_filters = json.loads(filters_str) if isinstance(filters_str, str) and filters_str else {
-                        "types": [], "tiers": [], "hard": False, "storm": False
-                    }
-                except json.JSONDecodeError:
-                    logging.warning(f"Ошибка декодирования fissure_filters для {chat_id}")
-                    fissure_filters = {
-                        "types": [], "tiers": [], "hard": False, "storm": False
-                    }
-                
-                # Проверка разрывов Бездны
-                if 'fissures' in subscriptions:
-                    fissures = validate_api_data(data, 'fissures')
-                    
-                    for fissure in fissures:
-                        mission_type = fissure.get('missionType')
-                        tier = fissure.get('tier')
-                        is_hard = fissure.get('isHard', False)
-                        is_storm = fissure.get('isStorm', False)
-                        eta = fissure.get('eta', 'Неизвестно')  # Получаем время до окончания
-                        
-                        # Проверка по фильтрам
-                        type_ok = not fissure_filters['types'] or mission_type in fissure_filters['types']
-                        
-                        # Используем обратный перевод для уровней
-                        tier_for_check = TIER_REVERSE_TRANSLATION.get(tier, tier)
-                        tier_ok = not fissure_filters['tiers'] or tier_for_check in fissure_filters['tiers']
-                        
-                        # Проверка флагов
-                        hard_ok = not fissure_filters['hard'] or is_hard == fissure_filters['hard']
-                        storm_ok = not fissure_filters['storm'] or is_storm == fissure_filters['storm']
-                        
-                        if type_ok and tier_ok and hard_ok and storm_ok:
-                            bot.send_message(chat_id, 
-                                f"⚡ Разрыв Бездны: {fissure.get('node', 'Неизвестно')}\n"
-                                f"Тип: {MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)}\n"
-                                f"Уровень: {TIER_TRANSLATION.get(tier, tier)}\n"
-                                f"⏳ Осталось: {eta}",
-                                parse_mode='Markdown'
-                            )
-            except Exception as e:
-                logging.error(f"Ошибка обработки уведомлений для {chat_id}: {e}", exc_info=True)
-                continue
+                subscriptions = subs.split(',') if isinstance(subs, str) and subs else []
+            except:
+                subscriptions = []
+            
+            # Извлечение и парсинг фильтров
+            try:
+                fissure_filters = json.loads(filters_str) if isinstance(filters_str, str) and filters_str else {
+                    "types": [], "tiers": [], "hard": False, "storm": False
+                }
+            except json.JSONDecodeError:
+                logging.warning(f"Ошибка декодирования fissure_filters для {chat_id}")
+                fissure_filters = {
+                    "types": [], "tiers": [], "hard": False, "storm": False
+                }
+            
+            # Проверка разрывов Бездны
+            if 'fissures' in subscriptions:
+                for fissure, expires in new_fissures:
+                    if fissure_matches_filters(fissure, fissure_filters):
+                        messages.append((chat_id, format_fissure_alert(fissure, expires), 'Markdown', expires))
+        except Exception as e:
+            logging.error(f"Ошибка обработки уведомлений для {chat_id}: {e}", exc_info=True)
+            continue
 
-@bot.message_handler(func=lambda m: m.text in LOCALE['MENU'])
-def handle_menu(message):
-    user_id = message.chat.id
-    data = get_api_data()
-    
-    if not is_data_valid(data):
-        bot.send_message(user_id, LOCALE['ERROR'])
+    return messages
+
+# Проход рассылки: пользователи читаются порциями по chat_id, курсор хранится в БД.
+# Прерванный (по бюджету времени, падению или смене лидера) проход продолжается с места остановки
+NOTIFY_PASS_LOCK = threading.Lock()
+NOTIFY_STATS = {}  # итоги последнего завершённого прохода для /health
+
+def run_notify_passes():
+    """Продолжает незавершённые проходы, пока не истечёт NOTIFY_TIME_BUDGET. True — всё разослано"""
+    if not NOTIFY_PASS_LOCK.acquire(blocking=False):
+        return True  # проход уже идёт в другом потоке, он и запланирует продолжение
+    try:
+        deadline = time.monotonic() + NOTIFY_TIME_BUDGET
+        while is_leader():
+            with sqlite3.connect(DATABASE) as conn:
+                row = conn.execute(
+                    "SELECT id, fissures, cursor, created, users, messages FROM notify_passes ORDER BY id LIMIT 1"
+                ).fetchone()
+            if not row:
+                return True
+            if not run_notify_pass(*row, deadline):
+                lag = time.time() - row[3]
+                logging.warning(f"Рассылка не уложилась в {NOTIFY_TIME_BUDGET} с, продолжим позже; отставание {int(lag)} с")
+                return False
+        return True
+    finally:
+        NOTIFY_PASS_LOCK.release()
+
+def run_notify_pass(pass_id, fissures_json, cursor, created, users, sent, deadline):
+    """Обходит подписчиков одного прохода до deadline. True — проход завершён"""
+    now = time.time()
+    new_fissures = [(fissure, expires) for fissure, expires in json.loads(fissures_json) if not expires or expires > now]
+    cursor = -2 ** 63 if cursor is None else cursor  # id групп отрицательные
+
+    while new_fissures and is_leader():
+        if time.monotonic() >= deadline:
+            return False
+        with sqlite3.connect(DATABASE) as conn:
+            batch = conn.execute(
+                "SELECT chat_id, timezone, subscriptions, fissure_filters FROM users "
+                "WHERE active=1 AND chat_id > ? ORDER BY chat_id LIMIT ?",
+                (cursor, NOTIFY_BATCH_SIZE)
+            ).fetchall()
+            if not batch:
+                break
+            messages = collect_fissure_messages(new_fissures, batch)
+            cursor = batch[-1][0]
+            users += len(batch)
+            sent += len(messages)
+            # Сообщения порции и новый курсор фиксируются вместе: после сбоя порция не повторится
+            enqueue_messages(messages, urgent=False, conn=conn)
+            conn.execute(
+                "UPDATE notify_passes SET cursor=?, users=?, messages=? WHERE id=?",
+                (cursor, users, sent, pass_id)
+            )
+            conn.commit()
+        if len(batch) < NOTIFY_BATCH_SIZE:
+            break
+
+    if not is_leader():
+        return True  # проход доведёт новый лидер
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute("DELETE FROM notify_passes WHERE id=?", (pass_id,))
+        conn.commit()
+    finished = time.time()
+    NOTIFY_STATS.update({'finished': finished, 'duration': finished - created, 'users': users, 'messages': sent})
+    logging.info(f"Проход рассылки завершён: {users} пользователей, {sent} сообщений за {finished - created:.1f} с")
+    return True
+
+def schedule_notify_resume():
+    scheduler.add_job(
+        resume_notify_passes, 'date',
+        run_date=datetime.now(pytz.utc) + timedelta(seconds=NOTIFY_RESUME_DELAY),
+        id=NOTIFY_RESUME_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+
+def resume_notify_passes():
+    """Продолжение прохода отдельной задачей — не ждёт следующей проверки снимка"""
+    if not is_leader():
         return
-    
-    if message.text == 'События 🎮':
-        events_info(message)
-    elif message.text == 'Вторжения 🌍':
-        invasions_info(message)
-    elif message.text == 'Разрывы Бездны ⚡':
-        show_fissure_submenu(message)
-    elif message.text == 'Баро Ки’Тиир 🚀':
-        baro_info(message)
-    elif message.text == 'Настройки ⚙️':
-        settings_menu(message)  # Передаём message, но внутри извлекаем chat_id
-    else:
-        bot.send_message(user_id, LOCALE['NO_DATA'])
+    try:
+        done = run_notify_passes()
+    except Exception as e:
+        logging.error(f"Ошибка прохода рассылки: {e}", exc_info=True)
+        done = False
+    if not done:
+        schedule_notify_resume()
+
+def notify_lag():
+    """Метрики отставания рассылки: незавершённые проходы и возраст самого старого из них"""
+    with sqlite3.connect(DATABASE) as conn:
+        pending, oldest = conn.execute("SELECT COUNT(*), MIN(created) FROM notify_passes").fetchone()
+    stats = {'pending_passes': pending, 'lag': int(time.time() - oldest) if oldest else 0}
+    if NOTIFY_STATS:
+        stats.update({
+            'last_pass_duration': round(NOTIFY_STATS['duration'], 1),
+            'last_pass_users': NOTIFY_STATS['users'],
+            'last_pass_messages': NOTIFY_STATS['messages'],
+            'last_pass_age': int(time.time() - NOTIFY_STATS['finished'])
+        })
+    return stats
 
 # Обработчики
-@bot.message_handler(commands=['start'])
+@route_command('start')
 def start(message):
     user = get_user(message.chat.id)
-    if not user:
+    if user:
+        set_chat_active(message.chat.id)
+    else:
         default_filters = {
             "types": [],
             "tiers": [],
@@ -458,22 +1760,32 @@ def start(message):
         reply_markup=create_main_menu()
     )
 
-@bot.message_handler(commands=['refresh'])
+@route_command('refresh')
 def refresh_cache(message):
-    global CACHE
-    try:
-        response = requests.get(API_URL, timeout=20)
-        response.raise_for_status()
-        CACHE.update({
-            'data': response.json(),
-            'expires': datetime.now() + timedelta(seconds=CACHE_TIMEOUT)
-        })
+    if not is_leader():
+        # К API ходит только лидер: ведомый лишь перечитывает его снимок, лимит команд не тратится
+        get_api_data(force=True)
+        fetched = CACHE.get('fetched')
+        age = f"{format_duration(time.time() - fetched)} назад" if fetched else "ещё не загружены"
+        bot.send_message(message.chat.id, f"Данные обновляет основной экземпляр бота, последние получены {age}")
+        return
+    
+    if not check_command_rate(message):
+        return
+    
+    # Свежий снимок не перезапрашиваем; одновременные /refresh сливаются в один запрос (FETCH_LOCK)
+    if time.time() - CACHE.get('fetched', 0) < REFRESH_MIN_AGE:
+        bot.send_message(message.chat.id, "Данные уже актуальны")
+        return
+    
+    requested = time.time()
+    get_api_data(force=True)
+    if CACHE.get('fetched', 0) >= requested:
         bot.send_message(message.chat.id, "Кэш обновлён")
-    except Exception as e:
-        logging.error(f"Ошибка обновления кэша: {e}", exc_info=True)
+    else:
         bot.send_message(message.chat.id, "Не удалось обновить кэш")
 
-@bot.message_handler(func=lambda m: m.text == 'Баро Ки’Тиир 🚀')
+@route_text('Баро Ки’Тиир 🚀')
 def baro_info(message):
     user_id = message.chat.id
     data = get_api_data()
@@ -482,18 +1794,30 @@ def baro_info(message):
         bot.send_message(user_id, LOCALE['NO_DATA'])
         return
     
-    trader = data.get('voidTraders', [{}])[0]
+    trader = (validate_api_data(data, 'voidTraders') or [{}])[0]
     user = get_user(user_id)
     user_tz = user['timezone'] if user else 'Europe/Moscow'
     
+    bot.send_message(user_id, format_baro(trader, user_tz), parse_mode='Markdown')
+
+def format_baro(trader, user_tz):
+    """Текст о Баро Ки’Тиире: время прибытия или отъезда и товары"""
     # Извлечение данных из API
     location = trader.get('location', 'Неизвестно')
     activation = trader.get('activation', 'Неизвестно')
     expiry = trader.get('expiry', 'Неизвестно')
-    start_string = trader.get('startString', 'Неизвестно')
-    end_string = trader.get('endString', 'Неизвестно')
+    start_string = format_remaining(activation)
+    end_string = format_remaining(expiry)
     active = trader.get('active', False)
     inventory = trader.get('inventory', [])
+
+    # Прибытие и отъезд определяем по текущему времени, а не по флагу из снимка
+    now = datetime.now(pytz.utc)
+    activation_dt, expiry_dt = parse_api_date(activation), parse_api_date(expiry)
+    if activation_dt and expiry_dt:
+        if expiry_dt <= now:
+            return f"🟠 **Баро Ки’Тиир**\nЛокация: {location}\nУже улетел, время следующего визита появится позже"
+        active = activation_dt <= now
     
     # Формирование текста времени
     time_text = ""
@@ -533,19 +1857,23 @@ def baro_info(message):
     text += f"Локация: {location}\n"
     text += f"{time_text}\n"
     text += items_text.strip()
-    
-    bot.send_message(user_id, text, parse_mode='Markdown')
+    return text
 
-@bot.message_handler(func=lambda m: m.text == LOCALE['SUBSCRIPTIONS'])
+@route_text(LOCALE['SUBSCRIPTIONS'])
 def subscriptions(message):
+    user = get_user(message.chat.id)
     bot.send_message(
         message.chat.id,
         LOCALE['SELECT_SUBSCRIPTION'],
-        reply_markup=create_subscriptions_menu(message.chat.id)
+        reply_markup=create_subscriptions_menu(user['subscriptions'] if user else [])
     )
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('toggle_'))
 def toggle_subscription(call):
+    with handler_context(call.message.chat.id, 'toggle_subscription'):
+        _toggle_subscription(call)
+
+def _toggle_subscription(call):
     try:
         user = get_user(call.message.chat.id)
         if not user:
@@ -571,6 +1899,11 @@ def toggle_subscription(call):
             })
         })
         
+        bot.edit_message_reply_markup(
+            message_id=call.message.message_id,
+            chat_id=call.message.chat.id,
+            reply_markup=create_subscriptions_menu(subscriptions)
+        )
         bot.answer_callback_query(call.id, LOCALE['NOTIFICATIONS_ENABLED'])
     
     except Exception as e:
@@ -578,7 +1911,7 @@ def toggle_subscription(call):
         logging.error(f"Ошибка обработки подписок: {e}", exc_info=True)
         bot.answer_callback_query(call.id, "Ошибка обработки")
 
-@bot.message_handler(func=lambda m: m.text == 'События 🎮')
+@route_text('События 🎮')
 def events_info(message):
     user_id = message.chat.id
     data = get_api_data()
@@ -594,6 +1927,9 @@ def events_info(message):
 
     text = "**Текущие события:**\n"
     for event in events:
+        if is_expired(event):
+            continue  # снимок мог пережить событие
+
         # Извлечение данных
         title = event.get('description', 'Без названия')  # Используем description вместо title
         location = event.get('node', 'Неизвестно')
@@ -601,12 +1937,7 @@ def events_info(message):
         active = event.get('active', False)
 
         # Рассчитываем оставшееся время
-        try:
-            expiry_dt = datetime.fromisoformat(expiry.replace('Z', '+00:00'))
-            now = datetime.now(pytz.utc)
-            eta = str(expiry_dt - now).split('.')[0]  # Убираем микросекунды
-        except:
-            eta = 'Неизвестно'
+        eta = format_remaining(expiry)
 
         # Извлечение наград
         rewards = event.get('rewards', [])
@@ -628,9 +1959,12 @@ def events_info(message):
         text += f"  Осталось: {eta}\n"
         text += f"  Статус: {status}\n\n"
 
+    if text == "**Текущие события:**\n":
+        text = LOCALE['NO_DATA']
+
     bot.send_message(user_id, text, parse_mode='Markdown')
 
-@bot.message_handler(func=lambda m: m.text == 'Вторжения 🌍')
+@route_text('Вторжения 🌍')
 def invasions_info(message):
     user_id = message.chat.id
     data = get_api_data()
@@ -653,7 +1987,7 @@ def invasions_info(message):
         node = inv.get('node', 'Неизвестно')
         attacker = inv.get('attacker', {}).get('faction', 'Неизвестно')
         defender = inv.get('defender', {}).get('faction', 'Неизвестно')
-        eta = inv.get('eta', 'Неизвестно')
+        eta = estimate_invasion_remaining(inv)
 
         # Извлечение наград атакующих
         attacker_reward = inv.get('attacker', {}).get('reward', {}).get('countedItems', [])
@@ -674,6 +2008,434 @@ def invasions_info(message):
 
     bot.send_message(user_id, text, parse_mode='Markdown')
 
+@route_text('Вылазка 🎯')
+def sortie_info(message):
+    user_id = message.chat.id
+    data = get_api_data()
+    sortie = data.get('sortie') if data else None
+
+    if not sortie or not sortie.get('variants') or is_expired(sortie):
+        bot.send_message(user_id, LOCALE['NO_DATA'])
+        return
+
+    text = f"🎯 **Вылазка:** {sortie.get('boss', 'Неизвестно')} ({sortie.get('faction', 'Неизвестно')})\n"
+    text += f"Осталось: {format_remaining(sortie.get('expiry'))}\n\n"
+    for number, variant in enumerate(sortie.get('variants', []), 1):
+        mission_type = variant.get('missionType', 'Неизвестно')
+        text += f"{number}. {MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)} — {variant.get('node', 'Неизвестно')}\n"
+        text += f"   Условие: {variant.get('modifier', 'Нет')}\n"
+
+    bot.send_message(user_id, text, parse_mode='Markdown')
+
+@route_text('Охота на Архонта 🐺')
+def archon_info(message):
+    user_id = message.chat.id
+    data = get_api_data()
+    hunt = data.get('archonHunt') if data else None
+
+    if not hunt or not hunt.get('missions') or is_expired(hunt):
+        bot.send_message(user_id, LOCALE['NO_DATA'])
+        return
+
+    text = f"🐺 **Охота на Архонта:** {hunt.get('boss', 'Неизвестно')} ({hunt.get('faction', 'Неизвестно')})\n"
+    text += f"Осталось: {format_remaining(hunt.get('expiry'))}\n\n"
+    for number, mission in enumerate(hunt.get('missions', []), 1):
+        mission_type = mission.get('type', 'Неизвестно')
+        text += f"{number}. {MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)} — {mission.get('node', 'Неизвестно')}\n"
+
+    bot.send_message(user_id, text, parse_mode='Markdown')
+
+@route_text('Арбитраж ⚖️')
+def arbitration_info(message):
+    user_id = message.chat.id
+    data = get_api_data()
+    arbitration = data.get('arbitration') if data else None
+
+    if not arbitration or not arbitration.get('node') or is_expired(arbitration):
+        bot.send_message(user_id, LOCALE['NO_DATA'])
+        return
+
+    user = get_user(user_id)
+    user_tz = user['timezone'] if user else 'Europe/Moscow'
+    mission_type = arbitration.get('type', 'Неизвестно')
+
+    text = "⚖️ **Арбитраж**\n"
+    text += f"Локация: {arbitration.get('node', 'Неизвестно')}\n"
+    text += f"Тип: {MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)}\n"
+    text += f"Противник: {arbitration.get('enemy', 'Неизвестно')}\n"
+    if arbitration.get('expiry'):
+        text += f"Окончание: {format_date(arbitration['expiry'], user_tz)}\n"
+
+    bot.send_message(user_id, text, parse_mode='Markdown')
+
+@route_text('Ночная волна 🌙')
+def nightwave_info(message):
+    user_id = message.chat.id
+    data = get_api_data()
+    nightwave = data.get('nightwave') if data else None
+
+    challenges = [
+        challenge for challenge in (nightwave or {}).get('activeChallenges', [])
+        if isinstance(challenge, dict) and not is_expired(challenge)
+    ]
+    if not challenges:
+        bot.send_message(user_id, LOCALE['NO_DATA'])
+        return
+
+    text = f"🌙 **Ночная волна** (сезон {nightwave.get('season', '?')})\n\n"
+    for challenge in challenges:
+        if challenge.get('isElite'):
+            kind = "⭐ Элитное"
+        elif challenge.get('isDaily'):
+            kind = "Ежедневное"
+        else:
+            kind = "Еженедельное"
+        text += f"• **{challenge.get('title', 'Без названия')}** ({kind}, {challenge.get('reputation', 0)} репутации)\n"
+        text += f"  {challenge.get('desc', '')}\n"
+
+    bot.send_message(user_id, text, parse_mode='Markdown')
+
+# Циклы открытых миров считаются локально, без запроса к API
+CYCLE_EPOCHS = {}  # ключ цикла -> точка отсчёта, уточнённая по последнему снимку
+
+def format_duration(seconds):
+    """Форматирует длительность в вид "1ч 05м" (или "3м 20с" для коротких)"""
+    seconds = max(int(seconds), 0)
+    days, rest = divmod(seconds, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes, secs = divmod(rest, 60)
+    if days:
+        return f"{days}д {hours}ч"
+    if hours:
+        return f"{hours}ч {minutes:02d}м"
+    return f"{minutes}м {secs:02d}с"
+
+def get_cycle_state(key, now=None):
+    """Возвращает (состояние, секунд до смены) для цикла из WORLD_CYCLES"""
+    cycle = WORLD_CYCLES[key]
+    now = time.time() if now is None else now
+    period = sum(duration for _, duration in cycle['states'])
+    position = (now - CYCLE_EPOCHS.get(key, cycle['epoch'])) % period
+    
+    for state, duration in cycle['states']:
+        if position < duration:
+            return state, duration - position
+        position -= duration
+    return cycle['states'][0][0], 0
+
+def resync_world_cycles(data):
+    """Уточняет точки отсчёта циклов по состоянию и expiry из снимка"""
+    for key, cycle in WORLD_CYCLES.items():
+        try:
+            section = data.get(key) or {}
+            state = section.get('state')
+            expiry = parse_api_date(section.get('expiry'))
+            if not expiry or state not in dict(cycle['states']):
+                continue
+            
+            # Начало текущего состояния = expiry - его длительность; от него отступаем к началу цикла
+            offset = 0
+            for name, duration in cycle['states']:
+                if name == state:
+                    break
+                offset += duration
+            CYCLE_EPOCHS[key] = expiry.timestamp() - dict(cycle['states'])[state] - offset
+        except Exception as e:
+            logging.warning(f"Не удалось синхронизировать цикл {key}: {e}")
+
+@route_text('Циклы миров 🌗')
+def cycles_info(message):
+    now = time.time()
+    text = "🌗 **Циклы открытых миров**\n\n"
+    for key, cycle in WORLD_CYCLES.items():
+        state, left = get_cycle_state(key, now)
+        text += f"• **{cycle['title']}:** {CYCLE_STATE_TRANSLATION.get(state, state)}\n"
+        text += f"  До смены: {format_duration(left)}\n"
+    
+    bot.send_message(message.chat.id, text, parse_mode='Markdown')
+
+# История: каждый разрыв, вторжение и визит Баро записывается один раз.
+# Строки кодируются целыми числами (history_codes), таблицы разбиты по месяцам активации
+HISTORY_CODES = {}          # (вид, значение) -> код
+HISTORY_PARTITIONS = set()  # уже созданные таблицы-партиции
+HISTORY_SEEN = set()        # uid из прошлого снимка, чтобы не писать их повторно
+HISTORY_LOCK = threading.Lock()
+
+FISSURE_HARD = 1
+FISSURE_STORM = 2
+
+def history_uid(kind, upstream_id):
+    """Компактный 63-битный ключ вместо строкового id из API"""
+    digest = hashlib.blake2b(f"{kind}:{upstream_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+def history_code(conn, kind, value):
+    key = (kind, str(value))
+    code = HISTORY_CODES.get(key)
+    if code is None:
+        conn.execute("INSERT OR IGNORE INTO history_codes (kind, value) VALUES (?, ?)", key)
+        code = conn.execute("SELECT id FROM history_codes WHERE kind=? AND value=?", key).fetchone()[0]
+        HISTORY_CODES[key] = code
+    return code
+
+def history_partition(conn, prefix, timestamp):
+    """Возвращает имя месячной таблицы, создавая её при первом обращении"""
+    name = f"{prefix}_{datetime.fromtimestamp(timestamp, pytz.utc):%Y%m}"
+    if name in HISTORY_PARTITIONS:
+        return name
+    if prefix == 'fissure_history':
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                uid INTEGER PRIMARY KEY,
+                node INTEGER NOT NULL,
+                mission INTEGER NOT NULL,
+                tier INTEGER NOT NULL,
+                flags INTEGER NOT NULL,
+                activation INTEGER NOT NULL,
+                expiry INTEGER NOT NULL
+            )
+        """)
+        # Уровень первым: индекс подходит и для "/stats axi", и для "/stats axi survival"
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_tier ON {name}(tier, flags, mission)")
+    else:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                uid INTEGER NOT NULL,
+                node INTEGER NOT NULL,
+                item INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                activation INTEGER NOT NULL,
+                PRIMARY KEY (uid, item)
+            ) WITHOUT ROWID
+        """)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_item ON {name}(item, activation)")
+    HISTORY_PARTITIONS.add(name)
+    return name
+
+def history_partitions(conn, prefix, since):
+    """Месячные таблицы, которые пересекаются с периодом начиная с since"""
+    first = f"{prefix}_{datetime.fromtimestamp(since, pytz.utc):%Y%m}"
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?", (f"{prefix}_%",)
+    ).fetchall()
+    return sorted(name for (name,) in rows if name >= first)
+
+def api_timestamp(value):
+    dt = parse_api_date(value)
+    return int(dt.timestamp()) if dt else None
+
+def record_history(data):
+    """Дописывает в историю разрывы, вторжения и визиты Баро, которых ещё не было"""
+    global HISTORY_SEEN
+    seen = set()
+    with HISTORY_LOCK:
+        try:
+            with sqlite3.connect(DATABASE) as conn:
+                for fissure in validate_api_data(data, 'fissures'):
+                    uid = history_uid('fissure', fissure.get('id'))
+                    activation = api_timestamp(fissure.get('activation'))
+                    expiry = api_timestamp(fissure.get('expiry'))
+                    seen.add(uid)
+                    if uid in HISTORY_SEEN or not activation or not expiry:
+                        continue
+                    flags = (FISSURE_HARD if fissure.get('isHard') else 0) | (FISSURE_STORM if fissure.get('isStorm') else 0)
+                    conn.execute(
+                        f"INSERT OR IGNORE INTO {history_partition(conn, 'fissure_history', activation)} VALUES (?,?,?,?,?,?,?)",
+                        (
+                            uid,
+                            history_code(conn, 'node', fissure.get('node')),
+                            history_code(conn, 'mission', fissure.get('missionType')),
+                            history_code(conn, 'tier', TIER_REVERSE_TRANSLATION.get(fissure.get('tier'), fissure.get('tier'))),
+                            flags, activation, expiry
+                        )
+                    )
+
+                for inv in validate_api_data(data, 'invasions'):
+                    uid = history_uid('invasion', inv.get('id'))
+                    activation = api_timestamp(inv.get('activation'))
+                    seen.add(uid)
+                    if uid in HISTORY_SEEN or not activation:
+                        continue
+                    table = history_partition(conn, 'invasion_history', activation)
+                    node = history_code(conn, 'node', inv.get('node'))
+                    for side in ('attacker', 'defender'):
+                        for reward in inv.get(side, {}).get('reward', {}).get('countedItems', []):
+                            conn.execute(
+                                f"INSERT OR IGNORE INTO {table} VALUES (?,?,?,?,?)",
+                                (uid, node, history_code(conn, 'item', reward.get('type')), reward.get('count', 1), activation)
+                            )
+
+                for trader in validate_api_data(data, 'voidTraders'):
+                    activation = api_timestamp(trader.get('activation'))
+                    expiry = api_timestamp(trader.get('expiry'))
+                    if not activation or not expiry:
+                        continue
+                    uid = history_uid('baro', activation)
+                    seen.add(uid)
+                    if uid not in HISTORY_SEEN:
+                        conn.execute(
+                            "INSERT OR IGNORE INTO baro_history VALUES (?,?,?,?)",
+                            (uid, history_code(conn, 'node', trader.get('location')), activation, expiry)
+                        )
+                conn.commit()
+        except Exception:
+            # Откат унёс и новые коды, и созданные партиции: кэши больше не соответствуют БД
+            HISTORY_CODES.clear()
+            HISTORY_PARTITIONS.clear()
+            raise
+    HISTORY_SEEN = seen
+
+def lookup_history_code(conn, kind, pattern):
+    """Ищет код по шаблону LIKE (без учёта регистра); возвращает (код, значение) или None"""
+    return conn.execute(
+        "SELECT id, value FROM history_codes WHERE kind=? AND value LIKE ? ORDER BY length(value) LIMIT 1",
+        (kind, pattern)
+    ).fetchone()
+
+def parse_fissure_query(words):
+    """Разбирает "axi survival sp" / "акси выживание сп" в (уровень, тип миссии, флаги)"""
+    tiers = {}
+    for key, value in TIER_TRANSLATION.items():
+        tiers[key.lower()] = key
+        tiers[value.lower()] = key
+    missions = {}
+    for key, value in MISSION_TYPES_TRANSLATION.items():
+        missions[key.lower()] = key
+        missions[value.split(' ', 1)[-1].lower()] = key
+
+    tier = mission = None
+    flags = 0
+    rest = []
+    for word in words:
+        lowered = word.lower()
+        if lowered in tiers:
+            tier = tiers[lowered]
+        elif lowered in ('sp', 'steel', 'сп', 'стальной'):
+            flags |= FISSURE_HARD
+        elif lowered in ('storm', 'буря'):
+            flags |= FISSURE_STORM
+        else:
+            rest.append(lowered)
+    if rest:
+        mission = missions.get(' '.join(rest))
+    return tier, mission, flags, rest
+
+def fissure_query_filters(words):
+    """Слова запроса ("axi sp") в фильтры разрывов того же вида, что users.fissure_filters; None — запрос не разобран"""
+    tier, mission, flags, rest = parse_fissure_query(words)
+    if rest and not mission:
+        return None
+    return {
+        'types': [mission] if mission else [],
+        'tiers': [tier] if tier else [],
+        'hard': bool(flags & FISSURE_HARD),
+        'storm': bool(flags & FISSURE_STORM)
+    }
+
+def fissure_query_key(filters):
+    """Фильтры в сравнимом виде (порядок элементов не важен)"""
+    return (
+        frozenset(filters.get('types', [])),
+        frozenset(filters.get('tiers', [])),
+        bool(filters.get('hard')),
+        bool(filters.get('storm'))
+    )
+
+def describe_fissure_filters(filters):
+    parts = [TIER_TRANSLATION.get(tier, tier) for tier in filters.get('tiers', [])]
+    parts += [MISSION_TYPES_TRANSLATION.get(mission, mission) for mission in filters.get('types', [])]
+    if filters.get('hard'):
+        parts.append("Стальной Путь 💎")
+    if filters.get('storm'):
+        parts.append("Буря Бездны 🌪️")
+    return ', '.join(parts) or "все разрывы"
+
+def format_timestamp(timestamp, timezone):
+    return format_date(datetime.fromtimestamp(timestamp, pytz.utc), timezone)
+
+@route_command('stats')
+def show_stats(message):
+    chat_id = message.chat.id
+    words = message.text.split()[1:]
+    if not words:
+        bot.send_message(
+            chat_id,
+            "Использование:\n"
+            "/stats <уровень> <тип миссии> [sp|storm] — например /stats axi survival sp\n"
+            "/stats <предмет> — когда награда последний раз была во вторжениях"
+        )
+        return
+    
+    user = get_user(chat_id)
+    user_tz = user['timezone'] if user else 'Europe/Moscow'
+    since = int(time.time()) - STATS_WINDOW_DAYS * 86400
+    tier, mission, flags, rest = parse_fissure_query(words)
+    
+    with sqlite3.connect(DATABASE) as conn:
+        if tier and (mission or not rest):
+            tier_code = lookup_history_code(conn, 'tier', tier)
+            mission_code = lookup_history_code(conn, 'mission', mission) if mission else None
+            partitions = history_partitions(conn, 'fissure_history', since)
+            if not partitions or not tier_code or (mission and not mission_code):
+                bot.send_message(chat_id, "Таких разрывов в истории пока нет")
+                return
+            
+            conditions = ["tier=?", "flags=?", "activation>=?"]
+            params = [tier_code[0], flags, since]
+            if mission:
+                conditions.append("mission=?")
+                params.append(mission_code[0])
+            union = " UNION ALL ".join(
+                f"SELECT activation, expiry FROM {name} WHERE {' AND '.join(conditions)}" for name in partitions
+            )
+            count, avg_duration, first_seen, last_seen = conn.execute(
+                f"SELECT COUNT(*), AVG(expiry - activation), MIN(activation), MAX(activation) FROM ({union})",
+                params * len(partitions)
+            ).fetchone()
+            
+            title = f"{TIER_TRANSLATION[tier]} {MISSION_TYPES_TRANSLATION.get(mission, 'любой тип')}"
+            if flags & FISSURE_HARD:
+                title += " (Стальной Путь)"
+            if flags & FISSURE_STORM:
+                title += " (Буря Бездны)"
+            if not count:
+                bot.send_message(chat_id, f"{title}: за {STATS_WINDOW_DAYS} дн. не встречался")
+                return
+            
+            days = max((time.time() - first_seen) / 86400, 1)
+            text = f"📊 **{title}** за {STATS_WINDOW_DAYS} дн.\n"
+            text += f"Встречался: {count} раз (≈{count / days:.1f} в день)\n"
+            text += f"Средняя длительность: {format_duration(avg_duration)}\n"
+            text += f"Последний раз: {format_timestamp(last_seen, user_tz)}\n"
+            if count > 1:
+                # Средний интервал между появлениями по агрегатам, без перебора строк
+                expected = last_seen + (last_seen - first_seen) / (count - 1)
+                if expected > time.time():
+                    text += f"Ожидается примерно: {format_timestamp(expected, user_tz)}\n"
+                else:
+                    text += "Ожидается: в любой момент\n"
+        else:
+            item = lookup_history_code(conn, 'item', f"%{' '.join(words)}%")
+            partitions = history_partitions(conn, 'invasion_history', since)
+            if not item or not partitions:
+                bot.send_message(chat_id, "Такой награды в истории вторжений нет")
+                return
+            union = " UNION ALL ".join(
+                f"SELECT uid, activation FROM {name} WHERE item=? AND activation>=?" for name in partitions
+            )
+            count, last_seen = conn.execute(
+                f"SELECT COUNT(DISTINCT uid), MAX(activation) FROM ({union})",
+                [item[0], since] * len(partitions)
+            ).fetchone()
+            if not count:
+                bot.send_message(chat_id, f"{item[1]}: за {STATS_WINDOW_DAYS} дн. во вторжениях не встречался")
+                return
+            text = f"📊 **{item[1]}** во вторжениях за {STATS_WINDOW_DAYS} дн.\n"
+            text += f"Вторжений с этой наградой: {count}\n"
+            text += f"Последний раз: {format_timestamp(last_seen, user_tz)}\n"
+    
+    bot.send_message(chat_id, text, parse_mode='Markdown')
+
 def format_rewards(rewards):
     """Форматирует награды с указанием количества предметов"""
     if not rewards:
@@ -687,7 +2449,595 @@ def format_rewards(rewards):
 
     return ", ".join(reward_items)
 
-@bot.message_handler(func=lambda m: m.text == 'Разрывы Бездны ⚡')
+# Поиск наград: инвертированный индекс, строится один раз на снимок
+TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya'
+})
+
+def tokenize_item_name(text):
+    """Разбивает название на токены в латинице, чтобы "форма" находила "Forma" и наоборот"""
+    return re.findall(r'\w+', str(text).lower().translate(TRANSLIT))
+
+def iter_snapshot_items(data):
+    """Перебирает (предмет, источник) по наградам вторжений, событий и товарам Баро"""
+    for inv in validate_api_data(data, 'invasions'):
+        if inv.get('completed', False):
+            continue
+        node = inv.get('node', 'Неизвестно')
+        for side in ('attacker', 'defender'):
+            faction = inv.get(side, {}).get('faction', 'Неизвестно')
+            for reward in inv.get(side, {}).get('reward', {}).get('countedItems', []):
+                yield reward.get('type', 'Неизвестно'), f"Вторжение: {node} (за {faction}) x{reward.get('count', 1)}"
+
+    for event in validate_api_data(data, 'events'):
+        title = event.get('description', 'Без названия')
+        for reward in event.get('rewards', []):
+            for item in reward.get('items', []):
+                yield item, f"Событие: {title}"
+            for counted in reward.get('countedItems', []):
+                yield counted.get('type', 'Неизвестно'), f"Событие: {title} x{counted.get('count', 1)}"
+
+    for trader in validate_api_data(data, 'voidTraders'):
+        location = trader.get('location', 'Неизвестно')
+        for item in trader.get('inventory', []) or []:
+            price_parts = []
+            if item.get('ducats'):
+                price_parts.append(f"{item['ducats']} дукатов")
+            if item.get('credits'):
+                price_parts.append(f"{item['credits']} кредитов")
+            yield item.get('item', 'Неизвестно'), f"Баро Ки’Тиир: {location} ({', '.join(price_parts)})"
+
+class ItemIndex:
+    """Индекс токен/префикс -> записи (предмет, источник) для одного снимка"""
+
+    def __init__(self, items):
+        self.entries = list(dict.fromkeys(items))  # без дублей, в исходном порядке
+        self.tokens = {}
+        self.prefixes = {}
+        for entry_id, (item, _) in enumerate(self.entries):
+            for token in tokenize_item_name(item):
+                self.tokens.setdefault(token, set()).add(entry_id)
+                for size in range(FIND_MIN_PREFIX, len(token)):
+                    self.prefixes.setdefault(token[:size], set()).add(entry_id)
+        self.vocabulary = list(self.tokens)
+
+    def lookup_token(self, token):
+        """Точное совпадение, затем начало слова, затем нечёткое совпадение"""
+        if token in self.tokens:
+            return self.tokens[token]
+        if token in self.prefixes:
+            return self.prefixes[token]
+        ids = set()
+        for close in difflib.get_close_matches(token, self.vocabulary, n=3, cutoff=FIND_FUZZY_CUTOFF):
+            ids |= self.tokens[close]
+        return ids
+
+    def search(self, query):
+        tokens = tokenize_item_name(query)
+        if not tokens:
+            return []
+        ids = None
+        for token in tokens:
+            found = self.lookup_token(token)
+            ids = found if ids is None else ids & found
+            if not ids:
+                return []
+        return [self.entries[entry_id] for entry_id in sorted(ids)]
+
+def get_item_index(data):
+    """Индекс для снимка: строится при первом поиске и живёт, пока живёт снимок"""
+    if isinstance(data, Snapshot):
+        return data.derived('item_index', lambda: ItemIndex(iter_snapshot_items(data)))
+    return ItemIndex(iter_snapshot_items(data))
+
+@route_command('find')
+def find_item(message):
+    chat_id = message.chat.id
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        bot.send_message(chat_id, "Использование: /find <предмет>\nНапример: /find форма")
+        return
+    
+    data = get_api_data()
+    if not is_data_valid(data):
+        bot.send_message(chat_id, LOCALE['ERROR'])
+        return
+    
+    results = get_item_index(data).search(parts[1])
+    if not results:
+        bot.send_message(chat_id, f"Сейчас «{parts[1]}» нигде не выдаётся")
+        return
+    
+    text = f"Где получить «{parts[1]}»:\n\n"
+    for item, source in results[:FIND_MAX_RESULTS]:
+        text += f"• {item} — {source}\n"
+    if len(results) > FIND_MAX_RESULTS:
+        text += f"\n…и ещё {len(results) - FIND_MAX_RESULTS}"
+    
+    bot.send_message(chat_id, text)
+
+# Списки наблюдения: термины всех пользователей собираются в один автомат Ахо–Корасик
+class WatchMatcher:
+    """Находит все термины из списков наблюдения в тексте за один проход"""
+
+    def __init__(self, terms):
+        self.goto = [{}]     # состояние -> {символ: следующее состояние}
+        self.fail = [0]
+        self.output = [[]]   # термины, заканчивающиеся в состоянии
+        for term in terms:
+            self._add(term)
+        self._build()
+
+    def _add(self, term):
+        state = 0
+        # Пробелы по краям: совпадение только целыми словами
+        for char in f" {term} ":
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(term)
+
+    def _build(self):
+        queue_ = list(self.goto[0].values())
+        for state in queue_:
+            for char, next_state in self.goto[state].items():
+                queue_.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                candidate = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = candidate if candidate != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find(self, text):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.output[state])
+        return found
+
+WATCH_MATCHER = None   # (версия, автомат, термин -> chat_id), пересобирается после изменения списков
+WATCH_MATCHER_LOCK = threading.Lock()
+def normalize_watch_term(term):
+    return ' '.join(tokenize_item_name(term))
+
+def get_watch_matcher():
+    """Автомат по спискам наблюдения; пересобирается, если версия в БД сменилась (на любом экземпляре)"""
+    global WATCH_MATCHER
+    with WATCH_MATCHER_LOCK:
+        with sqlite3.connect(DATABASE) as conn:
+            row = conn.execute("SELECT value FROM versions WHERE name='watchlist'").fetchone()
+            version = row[0] if row else 0
+            if WATCH_MATCHER is None or WATCH_MATCHER[0] != version:
+                subscribers = {}
+                for chat_id, term in conn.execute(
+                    "SELECT w.chat_id, w.term FROM watchlist w "
+                    "LEFT JOIN users u ON u.chat_id = w.chat_id WHERE COALESCE(u.active, 1)=1"
+                ):
+                    subscribers.setdefault(term, set()).add(chat_id)
+                WATCH_MATCHER = (version, WatchMatcher(subscribers), subscribers)
+        return WATCH_MATCHER[1:]
+
+def invalidate_watch_matcher(conn):
+    """Повышает версию списков наблюдения в той же транзакции, что и само изменение"""
+    conn.execute(
+        "INSERT INTO versions (name, value) VALUES ('watchlist', 1) "
+        "ON CONFLICT(name) DO UPDATE SET value=value+1"
+    )
+
+def collect_watchlist_messages(new_items):
+    """Сканирует новые предметы снимка [(предмет, источник)] один раз и собирает уведомления по спискам наблюдения"""
+    if not new_items:
+        return []
+
+    matcher, subscribers = get_watch_matcher()
+    if not subscribers:
+        return []
+
+    found = {}  # chat_id -> [(предмет, источник)]
+    for item, source in new_items:
+        for term in matcher.find(f" {normalize_watch_term(item)} "):
+            for chat_id in subscribers[term]:
+                found.setdefault(chat_id, []).append((item, source))
+
+    messages = []
+    for chat_id, entries in found.items():
+        text = "👁 Предметы из вашего списка наблюдения:\n\n"
+        text += '\n'.join(f"• {item} — {source}" for item, source in entries)
+        messages.append((chat_id, text, None))
+    return messages
+
+@route_command('watch')
+def watch_item(message):
+    chat_id = message.chat.id
+    parts = message.text.split(maxsplit=1)
+    term = normalize_watch_term(parts[1]) if len(parts) > 1 else ''
+    if not term:
+        bot.send_message(chat_id, "Использование: /watch <предмет>\nНапример: /watch Orokin Catalyst")
+        return
+    
+    with sqlite3.connect(DATABASE) as conn:
+        count = conn.execute("SELECT COUNT(*) FROM watchlist WHERE chat_id=?", (chat_id,)).fetchone()[0]
+        if count >= WATCHLIST_MAX_TERMS:
+            bot.send_message(chat_id, f"В списке наблюдения не больше {WATCHLIST_MAX_TERMS} предметов")
+            return
+        conn.execute("INSERT OR IGNORE INTO watchlist (chat_id, term) VALUES (?, ?)", (chat_id, term))
+        invalidate_watch_matcher(conn)
+        conn.commit()
+    
+    bot.send_message(chat_id, f"👁 Добавлено в список наблюдения: {parts[1].strip()}")
+
+@route_command('unwatch')
+def unwatch_item(message):
+    chat_id = message.chat.id
+    parts = message.text.split(maxsplit=1)
+    term = normalize_watch_term(parts[1]) if len(parts) > 1 else ''
+    if not term:
+        bot.send_message(chat_id, "Использование: /unwatch <предмет>")
+        return
+    
+    with sqlite3.connect(DATABASE) as conn:
+        deleted = conn.execute("DELETE FROM watchlist WHERE chat_id=? AND term=?", (chat_id, term)).rowcount
+        if deleted:
+            invalidate_watch_matcher(conn)
+        conn.commit()
+    
+    if deleted:
+        bot.send_message(chat_id, f"🗑 Удалено из списка наблюдения: {parts[1].strip()}")
+    else:
+        bot.send_message(chat_id, "Такого предмета нет в списке наблюдения")
+
+@route_command('watchlist')
+def show_watchlist(message):
+    chat_id = message.chat.id
+    with sqlite3.connect(DATABASE) as conn:
+        terms = [row[0] for row in conn.execute(
+            "SELECT term FROM watchlist WHERE chat_id=? ORDER BY term", (chat_id,)
+        )]
+    
+    if not terms:
+        bot.send_message(chat_id, "Список наблюдения пуст. Добавьте предмет: /watch <предмет>")
+        return
+    
+    bot.send_message(chat_id, "👁 Ваш список наблюдения:\n" + '\n'.join(f"▫️ {term}" for term in terms))
+
+# Живое табло: одно сообщение на чат, которое бот правит на месте вместо новых уведомлений
+def render_board(data, fissure_filters, timezone):
+    """Текст табло для фильтров пользователя.
+
+    Вместо обратного отсчёта показывается время окончания: текст меняется
+    только при изменении состава разрывов и вторжений.
+    """
+    now = datetime.now(pytz.utc)
+    fissures = []
+    for fissure in validate_api_data(data, 'fissures'):
+        if is_expired(fissure, now):
+            continue
+        if fissure_matches_filters(fissure, fissure_filters):
+            fissures.append((parse_api_date(fissure.get('expiry')) or now, fissure))
+    fissures.sort(key=lambda item: item[0])
+
+    lines = ["📋 Разрывы Бездны:"]
+    for _, fissure in fissures:
+        lines.append(f"⚡ {format_fissure_title(fissure)}\n   {format_fissure_place(fissure, timezone)}")
+    if not fissures:
+        lines.append("Нет разрывов под ваши фильтры")
+
+    lines.append("\n🌍 Вторжения:")
+    invasions = [inv for inv in validate_api_data(data, 'invasions') if not inv.get('completed', False)]
+    for inv in invasions:
+        attacker_reward = inv.get('attacker', {}).get('reward', {}).get('countedItems', [])
+        defender_reward = inv.get('defender', {}).get('reward', {}).get('countedItems', [])
+        lines.append(
+            f"• {inv.get('node', 'Неизвестно')}: {format_rewards(attacker_reward)} / {format_rewards(defender_reward)}"
+        )
+    if not invasions:
+        lines.append("Активных вторжений нет")
+    return '\n'.join(lines)
+
+def format_fissure_title(fissure):
+    """"Акси | 🪓 Выживание | 💎" — уровень, тип миссии и флаги разрыва"""
+    mission_type = fissure.get('missionType')
+    tier = fissure.get('tier')
+    return (
+        f"{TIER_TRANSLATION.get(tier, tier)} | {MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)}"
+        f"{' | 💎' if fissure.get('isHard') else ''}{' | 🌪️' if fissure.get('isStorm') else ''}"
+    )
+
+def format_fissure_place(fissure, timezone):
+    return f"{fissure.get('node', 'Неизвестно')}, до {format_date(fissure.get('expiry'), timezone)}"
+
+def board_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+def update_boards(data):
+    """Ставит в очередь правки табло, у которых изменился текст; неизменившиеся пропускаются"""
+    if not is_data_valid(data):
+        return
+    rendered = {}  # (фильтры, часовой пояс) -> (текст, хеш): одинаковые фильтры рендерятся один раз
+    edits = []
+    now = time.time()
+    with sqlite3.connect(DATABASE) as conn:
+        rows = conn.execute(
+            "SELECT b.chat_id, b.message_id, b.content_hash, u.fissure_filters, u.timezone "
+            "FROM boards b JOIN users u ON u.chat_id = b.chat_id WHERE u.active=1"
+        ).fetchall()
+        for chat_id, message_id, content_hash, filters_str, timezone in rows:
+            key = (filters_str, timezone)
+            if key not in rendered:
+                try:
+                    fissure_filters = json.loads(filters_str) if filters_str else {}
+                except json.JSONDecodeError:
+                    fissure_filters = {}
+                text = render_board(data, fissure_filters, timezone)
+                rendered[key] = (text, board_hash(text))
+            text, new_hash = rendered[key]
+            if new_hash != content_hash:
+                edits.append((chat_id, message_id, text, new_hash))
+
+        if not edits:
+            return
+        # Одной транзакцией: ещё не отправленная правка того же табло заменяется новой
+        conn.executemany(
+            "DELETE FROM outbox WHERE chat_id=? AND message_id=?",
+            [(chat_id, message_id) for chat_id, message_id, _, _ in edits]
+        )
+        conn.executemany(
+            "INSERT INTO outbox (chat_id, text, parse_mode, next_attempt, created, message_id) "
+            "VALUES (?, ?, NULL, ?, ?, ?)",
+            [(chat_id, text, now, now, message_id) for chat_id, message_id, text, _ in edits]
+        )
+        conn.executemany(
+            "UPDATE boards SET content_hash=?, updated=? WHERE chat_id=?",
+            [(new_hash, now, chat_id) for chat_id, _, _, new_hash in edits]
+        )
+        conn.commit()
+    OUTBOX_WAKEUP.set()
+    logging.info(f"Табло к обновлению: {len(edits)} из {len(rows)}")
+
+@route_command('board')
+def live_board(message):
+    chat_id = message.chat.id
+    parts = message.text.split(maxsplit=1)
+    if len(parts) > 1 and parts[1].strip().lower() in ('off', 'выкл'):
+        with sqlite3.connect(DATABASE) as conn:
+            conn.execute("DELETE FROM boards WHERE chat_id=?", (chat_id,))
+            conn.execute("DELETE FROM outbox WHERE chat_id=? AND message_id IS NOT NULL", (chat_id,))
+            conn.commit()
+        bot.send_message(chat_id, "Табло отключено")
+        return
+
+    user = get_user(chat_id)
+    if not user:
+        bot.send_message(chat_id, "Сначала отправьте /start")
+        return
+    data = get_api_data()
+    if not is_data_valid(data):
+        bot.send_message(chat_id, "Данные устарели или некорректны")
+        return
+
+    text = render_board(data, user.get('fissure_filters') or {}, user.get('timezone'))
+    sent = bot.send_message(chat_id, text)
+    with sqlite3.connect(DATABASE) as conn:
+        # Новое табло заменяет прежнее; старое сообщение просто перестаёт обновляться
+        conn.execute(
+            "INSERT INTO boards (chat_id, message_id, content_hash, updated) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET message_id=excluded.message_id, "
+            "content_hash=excluded.content_hash, updated=excluded.updated",
+            (chat_id, sent.message_id, board_hash(text), time.time())
+        )
+        conn.commit()
+
+    if message.chat.type in ('group', 'supergroup'):
+        try:
+            bot.pin_chat_message(chat_id, sent.message_id, disable_notification=True)
+        except telebot.apihelper.ApiTelegramException as e:
+            logging.info(f"Не удалось закрепить табло в {chat_id}: {e.description}")
+
+# Inline-режим: "@bot fissures axi steel" в любом чате. Ответы готовятся один раз на снимок
+INLINE_FISSURE_WORDS = {'fissures', 'fissure', 'разрывы', 'разрыв'}
+INLINE_BARO_WORDS = {'baro', 'баро'}
+
+class InlineAnswers:
+    """Готовые inline-результаты для снимка; ответ на одинаковые запросы собирается один раз"""
+
+    def __init__(self, data):
+        self.fissures = []  # [(разрыв, строка для сводки, результат)]
+        for fissure in validate_api_data(data, 'fissures'):
+            title = format_fissure_title(fissure)
+            place = format_fissure_place(fissure, INLINE_TIMEZONE)
+            text = f"⚡ Разрыв Бездны: {title}\n{place} ({INLINE_TIMEZONE_LABEL})"
+            self.fissures.append((fissure, f"⚡ {title}\n   {place}", telebot.types.InlineQueryResultArticle(
+                id=f"f:{fissure.get('id', len(self.fissures))}"[:64],
+                title=title,
+                description=place,
+                input_message_content=telebot.types.InputTextMessageContent(text)
+            )))
+
+        trader = (validate_api_data(data, 'voidTraders') or [{}])[0]
+        self.baro = [telebot.types.InlineQueryResultArticle(
+            id='baro',
+            title=f"{'🟢' if trader.get('active') else '🟠'} Баро Ки’Тиир",
+            description=trader.get('location', 'Неизвестно'),
+            input_message_content=telebot.types.InputTextMessageContent(
+                format_baro(trader, INLINE_TIMEZONE), parse_mode='Markdown'
+            )
+        )]
+        # Прибытие или отъезд Баро меняет текст ответа
+        now = datetime.now(pytz.utc)
+        changes = [parse_api_date(trader.get(key)) for key in ('activation', 'expiry')]
+        self.baro_valid_until = min([dt for dt in changes if dt and dt > now], default=None)
+        self.answers = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, query):
+        """(результаты, до какого момента они верны или None)"""
+        words = query.lower().split()
+        if words and words[0] in INLINE_BARO_WORDS:
+            return self.baro, self.baro_valid_until
+        if words and words[0] in INLINE_FISSURE_WORDS:
+            words = words[1:]
+
+        filters = fissure_query_filters(words)
+        if filters is None:
+            return [], None  # непонятный запрос
+        key = fissure_query_key(filters)
+        now = datetime.now(pytz.utc)
+        with self.lock:
+            # Ответ пересобирается, когда закрылся один из вошедших в него разрывов
+            if key not in self.answers or self.answers[key][1] <= now:
+                self.answers[key] = self._build(filters, now)
+            return self.answers[key]
+
+    def _build(self, filters, now):
+        matched = [
+            item for item in self.fissures
+            if not is_expired(item[0], now) and fissure_matches_filters(item[0], filters)
+        ]
+        expiries = [parse_api_date(fissure.get('expiry')) for fissure, _, _ in matched]
+        valid_until = min([dt for dt in expiries if dt] or [datetime.max.replace(tzinfo=pytz.utc)])
+        results = [result for _, _, result in matched]
+        if len(matched) > 1:
+            # Первым — сводка всех подходящих разрывов одним сообщением
+            summary = "⚡ Разрывы Бездны:\n" + '\n'.join(line for _, line, _ in matched)
+            results.insert(0, telebot.types.InlineQueryResultArticle(
+                id='all',
+                title=f"Все подходящие разрывы: {len(matched)}",
+                description=f"Время — {INLINE_TIMEZONE_LABEL}",
+                input_message_content=telebot.types.InputTextMessageContent(
+                    f"{summary}\n\nВремя — {INLINE_TIMEZONE_LABEL}"
+                )
+            ))
+        return results[:INLINE_MAX_RESULTS], valid_until
+
+def get_inline_answers(data):
+    if isinstance(data, Snapshot):
+        return data.derived('inline_answers', lambda: InlineAnswers(data))
+    return InlineAnswers(data)
+
+def snapshot_ttl():
+    """Сколько секунд ещё живёт текущий снимок — столько же Telegram может кэшировать ответ"""
+    expires = CACHE.get('expires')
+    if not expires:
+        return MIN_CHECK_INTERVAL
+    return max(1, int((expires - datetime.now()).total_seconds()))
+
+@bot.inline_handler(func=lambda query: True)
+def inline_query(query):
+    with handler_context(query.from_user.id, 'inline_query'):
+        data = get_api_data()
+        if not is_data_valid(data):
+            bot.answer_inline_query(query.id, [], cache_time=MIN_CHECK_INTERVAL)
+            return
+        results, valid_until = get_inline_answers(data).lookup(query.query)
+        # Telegram не должен держать ответ дольше, чем он верен: до конца снимка или закрытия разрыва
+        cache_time = snapshot_ttl()
+        if valid_until:
+            cache_time = min(cache_time, max(1, int((valid_until - datetime.now(pytz.utc)).total_seconds())))
+        bot.answer_inline_query(query.id, results, cache_time=cache_time)
+
+# Пресеты: популярные фильтры публикуются в канал один раз, а не копией каждому пользователю
+def collect_preset_messages(new_fissures):
+    """Одно сообщение в канал пресета на каждый подходящий разрыв — независимо от числа подписчиков"""
+    with sqlite3.connect(DATABASE) as conn:
+        presets = conn.execute("SELECT channel_id, fissure_filters FROM presets").fetchall()
+    
+    messages = []
+    for channel_id, filters_str in presets:
+        try:
+            filters = json.loads(filters_str)
+        except json.JSONDecodeError:
+            logging.warning(f"Ошибка декодирования фильтров пресета для канала {channel_id}")
+            continue
+        for fissure, expires in new_fissures:
+            if fissure_matches_filters(fissure, filters):
+                messages.append((channel_id, format_fissure_alert(fissure, expires), 'Markdown', expires))
+    return messages
+
+@route_command('preset_add')
+def add_preset(message):
+    chat_id = message.chat.id
+    if chat_id not in ADMIN_IDS:
+        return
+    words = message.text.split()[1:]
+    filters = fissure_query_filters(words[1:]) if words else None
+    if filters is None:
+        bot.send_message(
+            chat_id,
+            "Использование: /preset_add <@канал> [уровень] [тип миссии] [sp|storm]\n"
+            "Например: /preset_add @wf_axi_sp axi sp\n"
+            "Бот должен быть администратором канала."
+        )
+        return
+    
+    try:
+        channel = bot.get_chat(words[0])
+    except telebot.apihelper.ApiTelegramException as e:
+        bot.send_message(chat_id, f"Канал недоступен: {e.description}")
+        return
+    link = f"https://t.me/{channel.username}" if channel.username else channel.invite_link
+    
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "INSERT INTO presets (channel_id, title, link, fissure_filters) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(channel_id) DO UPDATE SET title=excluded.title, link=excluded.link, "
+            "fissure_filters=excluded.fissure_filters",
+            (channel.id, channel.title, link, json.dumps(filters))
+        )
+        conn.commit()
+    bot.send_message(chat_id, f"📢 Пресет «{describe_fissure_filters(filters)}» публикуется в {channel.title}")
+
+@route_command('preset_del')
+def delete_preset(message):
+    chat_id = message.chat.id
+    if chat_id not in ADMIN_IDS:
+        return
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        bot.send_message(chat_id, "Использование: /preset_del <номер из /presets>")
+        return
+    with sqlite3.connect(DATABASE) as conn:
+        deleted = conn.execute("DELETE FROM presets WHERE id=?", (int(parts[1]),)).rowcount
+        conn.commit()
+    bot.send_message(chat_id, "Пресет удалён" if deleted else "Пресет не найден")
+
+@route_command('presets')
+def show_presets(message):
+    chat_id = message.chat.id
+    with sqlite3.connect(DATABASE) as conn:
+        presets = conn.execute("SELECT id, title, link, fissure_filters FROM presets ORDER BY id").fetchall()
+    if not presets:
+        bot.send_message(chat_id, "Каналов с готовыми фильтрами пока нет")
+        return
+    
+    user = get_user(chat_id)
+    user_filters = (user or {}).get('fissure_filters') or {}
+    is_admin = chat_id in ADMIN_IDS
+    lines = ["📢 Каналы с уведомлениями о разрывах:"]
+    for preset_id, title, link, filters_str in presets:
+        filters = json.loads(filters_str)
+        same = fissure_query_key(filters) == fissure_query_key(user_filters)
+        lines.append(
+            f"{f'{preset_id}. ' if is_admin else ''}{title}: {describe_fissure_filters(filters)}"
+            f"{' ✅ как ваши фильтры' if same else ''}\n   {link or 'ссылка недоступна'}"
+        )
+    lines.append(
+        "\nПодпишитесь на канал и отключите подписку fissures в настройках, "
+        "чтобы не получать те же уведомления ещё и лично."
+    )
+    bot.send_message(chat_id, '\n'.join(lines), disable_web_page_preview=True)
+
+@route_text('Разрывы Бездны ⚡')
 def show_fissure_submenu(message):
     chat_id = message.chat.id
     markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -699,7 +3049,7 @@ def show_fissure_submenu(message):
     markup.row(telebot.types.KeyboardButton(LOCALE['BACK']))
     bot.send_message(chat_id, "Выберите тип разрывов:", reply_markup=markup)
 
-@bot.message_handler(func=lambda m: m.text in ["Стальной Путь 💎", "Буря Бездны 🌪️", "Обычные разрывы 🌌"])
+@route_text("Стальной Путь 💎", "Буря Бездны 🌪️", "Обычные разрывы 🌌")
 def handle_fissure_subcategories(message):
     chat_id = message.chat.id
     data = get_api_data()
@@ -708,7 +3058,7 @@ def handle_fissure_subcategories(message):
         bot.send_message(chat_id, LOCALE['ERROR'])
         return
     
-    fissures = validate_api_data(data, 'fissures')
+    fissures = [f for f in validate_api_data(data, 'fissures') if not is_expired(f)]
     filtered_fissures = []
     
     if message.text == "Стальной Путь 💎":
@@ -727,7 +3077,7 @@ def handle_fissure_subcategories(message):
         node = fissure.get('node', 'Неизвестно')
         mission_type = fissure.get('missionType', 'Неизвестно')
         tier = fissure.get('tier', 'Неизвестно')
-        eta = fissure.get('eta', 'Неизвестно')
+        eta = format_remaining(fissure.get('expiry'))
         
         mission_type_ru = MISSION_TYPES_TRANSLATION.get(mission_type, mission_type)
         tier_ru = TIER_TRANSLATION.get(tier, tier)
@@ -739,53 +3089,42 @@ def handle_fissure_subcategories(message):
     bot.send_message(chat_id, text, parse_mode='Markdown')
 
 # Новое меню настроек фильтров разрывов
-def create_fissure_filters_menu(chat_id):
-    """Создает меню фильтров с правильными данными для сравнения"""
-    user = get_user(chat_id)
-    if not user:
-        return None
-    
-    try:
-        filters = user.get('fissure_filters', {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        })
-        if isinstance(filters, str):
-            filters = json.loads(filters)
-    except json.JSONDecodeError:
-        filters = {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        }
-    
+def create_fissure_filters_menu(filters):
+    """Создает меню фильтров по текущему состоянию фильтров (без обращения к БД)"""
+    filters = filters or {}
+    return _fissure_filters_markup(
+        frozenset(filters.get('types', [])),
+        frozenset(filters.get('tiers', [])),
+        bool(filters.get('hard', False)),
+        bool(filters.get('storm', False))
+    )
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _fissure_filters_markup(types, tiers, hard, storm):
     markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     
     # Типы миссий (используем оригинальные ключи для callback)
     for key, value in MISSION_TYPES_TRANSLATION.items():
         markup.add(telebot.types.InlineKeyboardButton(
-            text=f"{'✅' if key in filters.get('types', []) else '❌'} {value}",
+            text=f"{'✅' if key in types else '❌'} {value}",
             callback_data=f"fissure_type_{key}"  # Сохраняем оригинальный ключ
         ))
     
     # Уровни разлома (используем оригинальные ключи для callback)
     for key, value in TIER_TRANSLATION.items():
         markup.add(telebot.types.InlineKeyboardButton(
-            text=f"{'✅' if key in filters.get('tiers', []) else '❌'} {value}",
+            text=f"{'✅' if key in tiers else '❌'} {value}",
             callback_data=f"fissure_tier_{key}"  # Сохраняем оригинальный ключ
         ))
     
     # Стальной Путь и Буря Бездны остаются без изменений
     markup.add(telebot.types.InlineKeyboardButton(
-        text=f"{'✅' if filters.get('hard', False) else '❌'} Стальной Путь 💎",
+        text=f"{'✅' if hard else '❌'} Стальной Путь 💎",
         callback_data="fissure_hard"
     ))
     
     markup.add(telebot.types.InlineKeyboardButton(
-        text=f"{'✅' if filters.get('storm', False) else '❌'} Буря Бездны 🌪️",
+        text=f"{'✅' if storm else '❌'} Буря Бездны 🌪️",
         callback_data="fissure_storm"
     ))
     
@@ -800,27 +3139,32 @@ def create_fissure_filters_menu(chat_id):
         callback_data="fissure_filter_save"
     ))
     
-    return markup
+    # Храним готовый JSON: telebot передаёт строку в API без повторной сериализации
+    return markup.to_json()
 
-@bot.message_handler(func=lambda m: m.text == LOCALE['FISSURE_FILTERS'])
+@route_text(LOCALE['FISSURE_FILTERS'])
 def open_fissure_filters(message):
     chat_id = message.chat.id
-    user = get_user(chat_id)
+    filters = get_filter_draft(chat_id)
     
-    if not user:
+    if filters is None:
         bot.send_message(chat_id, "Ошибка: пользователь не найден")
         return
     
-    # Отправка меню с текущими фильтрами
+    # Отправка меню с текущими фильтрами (включая несохранённые изменения)
     bot.send_message(
         chat_id,
         "Настройте фильтры разрывов Бездны:",
-        reply_markup=create_fissure_filters_menu(chat_id)
+        reply_markup=create_fissure_filters_menu(filters)
     )
 
 # Обработчик inline-кнопок
 @bot.callback_query_handler(func=lambda call: call.data.startswith('fissure_'))
 def toggle_fissure_filter(call):
+    with handler_context(call.message.chat.id, 'toggle_fissure_filter'):
+        _toggle_fissure_filter(call)
+
+def _toggle_fissure_filter(call):
     chat_id = call.message.chat.id
     data_parts = call.data.split('_')
     
@@ -830,66 +3174,9 @@ def toggle_fissure_filter(call):
     
     data_type = data_parts[1]
     value = data_parts[2] if len(data_parts) > 2 else ''
-    user = get_user(chat_id)
     
-    if not user:
-        bot.answer_callback_query(call.id, "Ошибка: пользователь не найден")
-        return
-    
-    try:
-        # Получаем и парсим фильтры
-        filters = user.get('fissure_filters', {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        })
-        
-        if isinstance(filters, str):
-            filters = json.loads(filters)
-    except json.JSONDecodeError:
-        filters = {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        }
-        logging.warning(f"Ошибка парсинга JSON для {chat_id}, используется дефолт")
-    
-    # Обработка событий
-    if data_type == 'type':
-        if value in filters['types']:
-            filters['types'].remove(value)
-        else:
-            filters['types'].append(value)
-    
-    elif data_type == 'tier':
-        if value in filters['tiers']:
-            filters['tiers'].remove(value)
-        else:
-            filters['tiers'].append(value)
-    
-    elif data_type == 'hard':
-        filters['hard'] = not filters.get('hard', False)
-    
-    elif data_type == 'storm':
-        filters['storm'] = not filters.get('storm', False)
-    
-    elif data_type == 'clear' and value == 'all':
-        filters = {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        }
-        bot.answer_callback_query(call.id, "Все фильтры сброшены")
-    
-    elif data_type == 'filter' and value == 'save':
-        save_user(chat_id, {
-            'timezone': user['timezone'],
-            'subscriptions': user['subscriptions'],
-            'fissure_filters': filters
-        })
+    if data_type == 'filter' and value == 'save':
+        commit_filter_draft(chat_id)
         
         bot.edit_message_text(
             message_id=call.message.message_id,
@@ -900,19 +3187,51 @@ def toggle_fissure_filter(call):
         bot.answer_callback_query(call.id, "Фильтры сохранены")
         return
     
-    else:
+    if data_type not in ('type', 'tier', 'hard', 'storm') and not (data_type == 'clear' and value == 'all'):
         bot.answer_callback_query(call.id, "Неизвестная команда")
         return
     
-    # Сохраняем обновленные фильтры
-    save_user(chat_id, {
-        'timezone': user['timezone'],
-        'subscriptions': user['subscriptions'],
-        'fissure_filters': filters
-    })
+    def change(filters):
+        # Обработка событий
+        if data_type == 'type':
+            if value in filters['types']:
+                filters['types'].remove(value)
+            else:
+                filters['types'].append(value)
+        
+        elif data_type == 'tier':
+            if value in filters['tiers']:
+                filters['tiers'].remove(value)
+            else:
+                filters['tiers'].append(value)
+        
+        elif data_type == 'hard':
+            filters['hard'] = not filters.get('hard', False)
+        
+        elif data_type == 'storm':
+            filters['storm'] = not filters.get('storm', False)
+        
+        else:
+            filters = {
+                "types": [], 
+                "tiers": [], 
+                "hard": False, 
+                "storm": False
+            }
+        return filters
+    
+    # Изменения копятся в черновике, в users пишем только при сохранении
+    filters = update_filter_draft(chat_id, change)
+    
+    if filters is None:
+        bot.answer_callback_query(call.id, "Ошибка: пользователь не найден")
+        return
+    
+    if data_type == 'clear':
+        bot.answer_callback_query(call.id, "Все фильтры сброшены")
     
     # Обновляем меню
-    new_markup = create_fissure_filters_menu(chat_id)
+    new_markup = create_fissure_filters_menu(filters)
     
     try:
         bot.edit_message_reply_markup(
@@ -928,53 +3247,8 @@ def toggle_fissure_filter(call):
             logging.warning(f"Telegram API ошибка: {e.result_json.get('description', 'Неизвестная ошибка')}")
             bot.answer_callback_query(call.id, "Ошибка обновления меню")
 
-# Обработчик команды настройки фильтров
-@bot.message_handler(func=lambda m: m.text == 'Разрывы Бездны ⚡')
-def show_fissure_settings(message):
-    chat_id = message.chat.id
-    user = get_user(chat_id)
-    
-    if not user:
-        bot.send_message(chat_id, "Ошибка: пользователь не найден")
-        return
-    
-    try:
-        # Получение фильтров
-        filters = user.get('fissure_filters', {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        })
-        
-        if isinstance(filters, str):
-            filters = json.loads(filters)
-    
-    except json.JSONDecodeError:
-        filters = {
-            "types": [], 
-            "tiers": [], 
-            "hard": False, 
-            "storm": False
-        }
-        bot.send_message(chat_id, "Ошибка: фильтры повреждены, установлены дефолтные значения")
-    
-    try:
-        # Обновляем фильтры у пользователя
-        user['fissure_filters'] = filters
-        
-        # Отправляем меню
-        bot.send_message(
-            chat_id,
-            "Настройте фильтры разрывов Бездны:",
-            reply_markup=create_fissure_filters_menu(chat_id)
-        )
-    
-    except Exception as e:
-        logging.error(f"Ошибка открытия меню фильтров: {e}", exc_info=True)
-        bot.send_message(chat_id, "Не удалось загрузить фильтры разрывов")
-
-@bot.message_handler(commands=['myfilters'])
+@route_command('myfilters')
+@route_text(LOCALE['MY_FILTERS'])
 def show_filters(message):
     chat_id = message.chat.id
     user = get_user(chat_id)
@@ -1018,16 +3292,7 @@ def show_filters(message):
 ▫️ Буря Бездны: {storm_status}
 """, parse_mode='Markdown')
 
-@bot.message_handler(func=lambda m: m.text == LOCALE['MY_FILTERS'])
-def show_filters_menu(message):
-    chat_id = message.chat.id
-    show_filters(message)  # Вызываем команду /myfilters
-
-@bot.message_handler(func=lambda m: m.text == LOCALE['MY_FILTERS'])
-def show_current_filters(message):
-    show_filters(message)
-
-@bot.message_handler(commands=['clearfilters'])
+@route_command('clearfilters')
 def reset_filters(message):
     chat_id = message.chat.id
     user = get_user(chat_id)
@@ -1036,6 +3301,7 @@ def reset_filters(message):
         bot.send_message(chat_id, "Ошибка: пользователь не найден")
         return
     
+    discard_filter_draft(chat_id)
     save_user(chat_id, {
         'timezone': user['timezone'],
         'subscriptions': user['subscriptions'],
@@ -1049,11 +3315,54 @@ def reset_filters(message):
     
     bot.send_message(chat_id, "🗑 Все фильтры разрывов Бездны сброшены")
 
-@bot.message_handler(func=lambda m: m.text == LOCALE['BACK'])
+@route_command('quiet')
+def quiet_hours(message):
+    chat_id = message.chat.id
+    user = get_user(chat_id)
+    if not user:
+        bot.send_message(chat_id, "Ошибка: пользователь не найден")
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        with sqlite3.connect(DATABASE) as conn:
+            quiet_start, quiet_end = conn.execute(
+                "SELECT quiet_start, quiet_end FROM users WHERE chat_id=?", (chat_id,)
+            ).fetchone()
+        current = f"{quiet_start:02d}:00–{quiet_end:02d}:00" if quiet_start is not None else "выключены"
+        bot.send_message(
+            chat_id,
+            f"🌙 Тихие часы: {current} ({user['timezone']})\n"
+            "Настроить: /quiet 23-8\nВыключить: /quiet off"
+        )
+        return
+    
+    if parts[1].strip().lower() in ('off', 'выкл'):
+        quiet_start = quiet_end = None
+    else:
+        match = re.fullmatch(r'\s*(\d{1,2})(?::00)?\s*-\s*(\d{1,2})(?::00)?\s*', parts[1])
+        if not match or int(match.group(1)) > 23 or int(match.group(2)) > 23 or match.group(1) == match.group(2):
+            bot.send_message(chat_id, "Неверный формат. Пример: /quiet 23-8")
+            return
+        quiet_start, quiet_end = int(match.group(1)), int(match.group(2))
+    
+    with sqlite3.connect(DATABASE) as conn:
+        conn.execute(
+            "UPDATE users SET quiet_start=?, quiet_end=? WHERE chat_id=?",
+            (quiet_start, quiet_end, chat_id)
+        )
+        conn.commit()
+    
+    if quiet_start is None:
+        bot.send_message(chat_id, "🔔 Тихие часы выключены")
+    else:
+        bot.send_message(chat_id, f"🌙 Тихие часы: {quiet_start:02d}:00–{quiet_end:02d}:00. Уведомления будут приходить после {quiet_end:02d}:00")
+
+@route_text(LOCALE['BACK'])
 def back_to_menu(message):
     bot.send_message(message.chat.id, "Главное меню:", reply_markup=create_main_menu())
 
-@bot.message_handler(func=lambda m: m.text == LOCALE['SET_TIMEZONE'])
+@route_text(LOCALE['SET_TIMEZONE'])
 def set_timezone(message):
     markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
     
@@ -1115,7 +3424,7 @@ def set_timezone(message):
     markup.row(telebot.types.KeyboardButton(LOCALE['BACK']))
     bot.send_message(message.chat.id, "Выберите часовой пояс:", reply_markup=markup)
 
-@bot.message_handler(func=lambda m: m.text.startswith('+') or m.text.startswith('-'))
+@route_pattern(lambda text: text.startswith('+') or text.startswith('-'))
 def custom_timezone(message):
     try:
         offset = int(message.text.split(':')[0])
@@ -1130,7 +3439,7 @@ def custom_timezone(message):
     except ValueError:
         bot.send_message(message.chat.id, "Неверный формат. Используйте +HH:MM или -HH:MM")
 
-@bot.message_handler(func=lambda m: "(UTC" in m.text)
+@route_pattern(lambda text: "(UTC" in text)
 def handle_timezone_selection(message):
     """Обрабатывает выбор пользовательского часового пояса"""
     try:
@@ -1155,25 +3464,73 @@ def handle_timezone_selection(message):
         logging.error(f"Ошибка выбора часового пояса: {e}")
         bot.send_message(message.chat.id, "Ошибка установки часового пояса")
 
-# Инициализация
-init_db()
-scheduler.add_job(check_notifications, 'interval', minutes=10)
-scheduler.start()
-
 app = Flask(__name__)
 
 @app.route('/')
 def home():
     return "Бот работает!", 200
 
+@app.route('/health')
+def health():
+    fetched = CACHE.get('fetched')
+    return jsonify({
+        'instance': INSTANCE_ID,
+        'leader': is_leader(),
+        'upstream': UPSTREAM_BREAKER.status(),
+        'snapshot_age': int(time.time() - fetched) if fetched else None,
+        'notifications': notify_lag()
+    }), 200
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return "Forbidden", 403
+    update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    bot.process_new_updates([update])
+    return "", 200
+
 def run_server():
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port)
 
-# Запуск сервера в отдельном потоке
-server_thread = threading.Thread(target=run_server)
-server_thread.daemon = True
-server_thread.start()
+def start_services():
+    """Инициализирует БД и запускает фоновые задачи (всё, кроме приёма обновлений)"""
+    init_db()
+    renew_leadership()  # лидер сразу запускает проверку уведомлений
+    scheduler.add_job(renew_leadership, 'interval', seconds=LEASE_HEARTBEAT)
+    scheduler.add_job(commit_expired_filter_drafts, 'interval', seconds=60)
+    scheduler.add_job(purge_inactive_chats, 'interval', hours=24)
+    scheduler.start()
+    atexit.register(release_leadership)
+
+    # Запуск отправки сообщений из очереди
+    outbox_thread = threading.Thread(target=outbox_worker)
+    outbox_thread.daemon = True
+    outbox_thread.start()
+
+def handle_sigterm(signum, frame):
+    """Heroku и контейнеры останавливают процесс SIGTERM, а atexit срабатывает только при обычном выходе"""
+    logging.info("Получен SIGTERM, останавливаемся")
+    sys.exit(0)  # release_leadership и остановка логов выполнятся через atexit
+
+def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    setup_logging()
+    start_services()
+
+    if WEBHOOK_URL:
+        # Несколько экземпляров за балансировщиком: Telegram присылает обновления на /webhook
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + '/webhook', secret_token=WEBHOOK_SECRET)
+        run_server()
+    else:
+        # Запуск сервера в отдельном потоке
+        server_thread = threading.Thread(target=run_server)
+        server_thread.daemon = True
+        server_thread.start()
+
+        # Запуск бота
+        bot.infinity_polling()
 
-# Запуск бота
-bot.infinity_polling()
\ No newline at end of file
+if __name__ == '__main__':
+    main()